@@ -14,19 +14,17 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import re
 import json
-import socket
 import hashlib
 import logging
 
-from urllib.request import urlopen
-from urllib.error import URLError, HTTPError
-from http.client import HTTPException
-from time import sleep, time, gmtime, strftime
+from time import gmtime, strftime
+from urllib.parse import urlsplit
 
-from danbooru.error import DanbooruError
-from danbooru.utils import filter_posts
+from danbooru.error import DanbooruError, HTTPStatusError
+from danbooru.connection import ConnectionPool
+from danbooru.ratelimit import get_bucket, retry_after
+from danbooru.utils import PostFilter, iter_json_array
 
 
 class Api(object):
@@ -37,19 +35,20 @@ class Api(object):
     POOL_LIST_API = "/pool/show.json"
 
     WAIT_TIME = 1.2
+    # times to wait for the server when it answers 429 or 503
+    MAX_BACKOFFS = 5
 
-    def __init__(self, host, username, password, salt):
+    def __init__(self, host, username, password, salt, pool=None, rate=None, burst=1):
         self.host = host
         self.username = username
         self.password = password
         self.salt = salt
-        self._delta_time = 0
+        self.pool = pool or ConnectionPool()
+        self.limiter = get_bucket(urlsplit(host).netloc, rate or 1.0 / self.WAIT_TIME, burst)
         self._login_string = None
 
     def _wait(self):
-        self._delta_time = time() - self._delta_time
-        if self._delta_time < self.WAIT_TIME:
-            sleep(self.WAIT_TIME - self._delta_time)
+        self.limiter.acquire()
 
     def _loginData(self):
         if not self._login_string:
@@ -80,15 +79,14 @@ class Api(object):
     def getTagsBefore(self, post_id, tags, limit):
         pass
 
-    def _processPosts(self, posts, query=None, blacklist=None, whitelist=None):
+    def _processPosts(self, posts, post_filter):
+        '''Normalizes and filters the posts as they are parsed.'''
+        post_count = 0
         for post in posts:
             # rename key id -> post_id
-            post['post_id'] = post['id']
-            del post['id']
-            #remove all extra spaces
-            post['tags'] = re.sub(' +', ' ', post['tags']).split(' ')
-            #remove duplicates
-            post['tags'] = list(set(post['tags']))
+            post['post_id'] = post.pop('id')
+            # without extra spaces or duplicates
+            post['tags'] = PostFilter.splitTags(post['tags'])
             if not "has_comments" in post:
                 post['has_comments'] = None
             if not "has_notes" in post:
@@ -96,75 +94,60 @@ class Api(object):
             if "created_at" in post and isinstance(post['created_at'], dict):
                 post['created_at'] = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime(post['created_at']['s']))
 
-        if blacklist:
-            post_count = len(posts)
-            # delete posts that have tags in blacklist
-            if whitelist:
-                # but exclude those in the whitelist
-                posts[:] = [x for x in posts if not set(x['tags']).intersection(blacklist) or set(x['tags']).intersection(whitelist)]
+            # skip posts that have tags in blacklist but not in the whitelist
+            if post_filter.blacklist and post_filter.blacklisted(post['tags']):
+                post_count += 1
+                continue
+
+            if post_filter.checks and not post_filter.matchesQuery(post):
+                continue
+            yield post
+
+        if post_count > 0:
+            logging.debug("%i posts filtered by the blacklist", post_count)
+
+    def _getResponse(self, url):
+        backoffs = 0
+        while True:
+            self._wait()
+            try:
+                response = self.pool.request(url)
+            except HTTPStatusError as ex:
+                if ex.code not in (429, 503) or backoffs >= self.MAX_BACKOFFS:
+                    raise
+                backoffs += 1
+                delay = self.limiter.backoff(retry_after(ex.headers))
+                logging.warning("%s, waiting %.1f seconds", ex.message, delay)
             else:
-                posts[:] = [x for x in posts if not set(x['tags']).intersection(blacklist) or set(x['tags'])]
-            post_count = post_count - len(posts)
-            if post_count > 0:
-                logging.debug("%i posts filtered by the blacklist", post_count)
-
-        if query:
-            return filter_posts(posts, query)
-        else:
-            return posts
+                self.limiter.success()
+                return response
 
     def _getData(self, url):
-        self._wait()
-        try:
-            response = urlopen(url)
-        except HTTPError as ex:
-            raise DanbooruError("Error %i: %s" % (ex.code, ex.msg))
-        except URLError as ex:
-            raise DanbooruError("%s (%s)" % (ex.reason, self.host))
-        except HTTPException as ex:
-            raise DanbooruError("Error: HTTPException")
-        except socket.error as ex:
-            raise DanbooruError("Connection error: %s" % ex)
-        return response.read().decode('utf8')
+        with self._getResponse(url) as response:
+            return response.read().decode('utf8')
+
+    def _iterPosts(self, response):
+        with response:
+            try:
+                for post in iter_json_array(response):
+                    yield post
+            except ValueError as ex:
+                raise DanbooruError("Invalid response from %s: %s" % (self.host, ex))
 
     def getPosts(self, url, query, blacklist, whitelist):
-        posts = json.loads(self._getData(url))
-        return self._processPosts(posts, query, blacklist, whitelist)
+        '''Returns a generator of the posts, parsed while the page is received.
+        The query can be a PostFilter already compiled with the tag lists.'''
+        if not isinstance(query, PostFilter):
+            query = PostFilter(query, blacklist, whitelist)
+        response = self._getResponse(url)
+        return self._processPosts(self._iterPosts(response), query)
 
     def getPoolPosts(self, url):
-        self._wait()
-
-        try:
-            response = urlopen(url)
-        except HTTPError as ex:
-            raise DanbooruError("Error %i: %s" % (ex.code, ex.msg))
-        except URLError as ex:
-            raise DanbooruError("%s (%s)" % (ex.reason, self.host))
-        except HTTPException as ex:
-            raise DanbooruError("Error: HTTPException")
-        except socket.error as ex:
-            raise DanbooruError("Connection error: %s" % ex)
-
-        results = response.read().decode('utf8')
-        pool = json.loads(results)
+        pool = json.loads(self._getData(url))
         return [post['id'] for post in pool['posts']]
 
     def getPools(self, url):
-        self._wait()
-
-        try:
-            response = urlopen(url)
-        except HTTPError as ex:
-            raise DanbooruError("Error %i: %s" % (ex.code, ex.msg))
-        except URLError as ex:
-            raise DanbooruError("%s (%s)" % (ex.reason, self.host))
-        except HTTPException as ex:
-            raise DanbooruError("Error: HTTPException")
-        except socket.error as ex:
-            raise DanbooruError("Connection error: %s" % ex)
-
-        results = response.read().decode('utf8')
-        pools = json.loads(results)
+        pools = json.loads(self._getData(url))
         for pool in pools:
             # rename key id -> pool_id
             pool['pool_id'] = pool['id']
@@ -172,18 +155,5 @@ class Api(object):
         return pools
 
     def tagList(self, name):
-        self._wait()
         url = self.host + self.TAG_API + '?name=%s' % name + self._loginData()
-        try:
-            response = urlopen(url)
-            results = response.read().decode('utf8')
-            tags = json.loads(results)
-            return tags
-        except HTTPError as ex:
-            raise DanbooruError("Error %i: %s" % (ex.code, ex.msg))
-        except URLError as ex:
-            raise DanbooruError("%s (%s)" % (ex.reason, self.host))
-        except HTTPException as ex:
-            raise DanbooruError("Error: HTTPException")
-        except socket.error as ex:
-            raise DanbooruError("Connection error: %s" % ex)
+        return json.loads(self._getData(url))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from threading import Lock
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''Bounded mapping that evicts the least recently used entries'''
+
+    MAX_SIZE = 1024
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.MAX_SIZE
+        # the state of the database the entries were read from
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def update(self, items):
+        for key, value in items:
+            self.set(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def validate(self, generation):
+        '''Clears the cache if it was filled with another generation of the
+        data.'''
+        with self._lock:
+            if generation != self.generation:
+                self._items.clear()
+                self.generation = generation
+
+    def stats(self):
+        return {'size': len(self._items), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class TagCache(LRUCache):
+    '''Maps tag names to their ids in the tag table, the generation is the
+    tags counter, bumped when tags without posts are deleted as sqlite can
+    reuse their ids'''
+
+    MAX_SIZE = 200000
+
+    def lookup(self, names):
+        '''Returns the cached ids and the list of names not in the cache.'''
+        found = {}
+        missing = []
+        for name in names:
+            tag_id = self.get(name)
+            if tag_id is None:
+                missing.append(name)
+            else:
+                found[name] = tag_id
+        return found, missing
+
+
+class QueryCache(LRUCache):
+    '''Maps normalized searches to the ids they found, all of them are
+    dropped when the posts change'''
+
+    MAX_SIZE = 64
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import sys
+import zlib
+import socket
+from threading import Lock
+from urllib.parse import urlsplit, urljoin
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+
+from danbooru.error import DanbooruError, HTTPStatusError
+
+
+class Response(object):
+    '''Body of a pooled request, decoded from gzip/deflate while it's read'''
+
+    def __init__(self, pool, key, connection, response):
+        self.status = response.status
+        self.headers = response.msg
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+        self._decoded = False
+        encoding = self.headers.get('Content-Encoding', '').lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+        else:
+            self._decoder = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def _decode(self, data):
+        first = not self._decoded
+        self._decoded = True
+        try:
+            return self._decoder.decompress(data)
+        except zlib.error:
+            if not first or self.headers.get('Content-Encoding', '').lower() != 'deflate':
+                raise
+            # some servers send raw deflate streams without the zlib header
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(data)
+
+    def read(self, amt=None):
+        '''Reads up to amt bytes of the raw body and returns them decoded.'''
+        try:
+            while True:
+                data = self._response.read(amt)
+                if not self._decoder:
+                    return data
+                if not data:
+                    return self._decoder.flush()
+                data = self._decode(data)
+                if data:
+                    return data
+        except (HTTPException, socket.error, zlib.error) as ex:
+            self.close()
+            raise DanbooruError("Connection error: %s" % (ex or ex.__class__.__name__))
+
+    def close(self):
+        if not self._connection:
+            return
+        if self._response.isclosed():
+            # the whole body was read, the connection can be reused
+            self._pool.release(self._key, self._connection)
+        else:
+            self._connection.close()
+        self._connection = None
+
+
+class ConnectionPool(object):
+    '''Keeps the HTTP connections alive to reuse them between requests'''
+
+    TIMEOUT = 30
+    MAX_IDLE = 4
+    MAX_REDIRECTS = 5
+    USER_AGENT = "Python-urllib/%i.%i" % sys.version_info[:2]
+
+    def __init__(self, timeout=None, max_idle=None):
+        self.timeout = timeout or self.TIMEOUT
+        self.max_idle = max_idle or self.MAX_IDLE
+        self._idle = {}
+        self._lock = Lock()
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            return HTTPSConnection(host, port, timeout=self.timeout), False
+        return HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle.clear()
+
+    def _send(self, key, path, headers):
+        while True:
+            connection, reused = self._acquire(key)
+            try:
+                connection.request("GET", path, headers=headers)
+                return connection, connection.getresponse()
+            except (HTTPException, socket.error):
+                connection.close()
+                # the server may have dropped an idle connection, try again
+                # with a new one
+                if not reused:
+                    raise
+
+    def request(self, url, headers=None, compress=True):
+        '''Sends a GET request and returns its Response, following redirects.
+        The response must be closed to give the connection back to the pool.'''
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+
+            request_headers = {'User-Agent': self.USER_AGENT}
+            if compress:
+                request_headers['Accept-Encoding'] = "gzip, deflate"
+            if headers:
+                request_headers.update(headers)
+
+            try:
+                connection, response = self._send(key, path, request_headers)
+            except HTTPException as ex:
+                raise DanbooruError("Error: %s" % (ex or ex.__class__.__name__))
+            except socket.error as ex:
+                raise DanbooruError("Connection error: %s (%s)" % (ex, parts.hostname))
+
+            result = Response(self, key, connection, response)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                result.read()
+                result.close()
+                url = urljoin(url, response.getheader('Location'))
+            elif response.status >= 400:
+                result.read()
+                result.close()
+                raise HTTPStatusError(response.status, response.reason, response.msg)
+            else:
+                return result
+        raise DanbooruError("Too many redirects (%s)" % url)
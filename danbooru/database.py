@@ -15,29 +15,100 @@
 #   limitations under the License.
 
 import os
+import re
+import logging
+from array import array
+from threading import Lock
 
 from sqlalchemy import event
-from sqlalchemy.orm import scoped_session, joinedload
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.engine import create_engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm.session import sessionmaker
-from sqlalchemy.sql.expression import func, ClauseElement, distinct, not_
+from sqlalchemy.sql.expression import func, ClauseElement, not_, select, and_, or_, bindparam, exists
 
-from danbooru.models import Board, Post, Image, Tag, Base, Pool
+from danbooru.models import Board, Post, Image, Tag, Base, Pool, Counter, PostRow, PostDetails
+from danbooru.models import association_table__tag_post, association_table__pool_post
+from danbooru.cache import TagCache, QueryCache
+from danbooru.index import TagIndex
+from danbooru.utils import split_tags
+from danbooru.error import DanbooruError
+from danbooru.migrations import migrate
 
 
 class Database(object):
 
-    def __init__(self, dbname=""):
-        # prepare the engine
-        self.engine = create_engine("sqlite:///%s" % dbname)
+    # keep IN (...) lists below the sqlite host parameter limit
+    IN_CHUNK_SIZE = 500
+
+    # applied in this order to every new connection, WAL lets the GUI read
+    # while the daemon writes. Each one can be overridden in the config file
+    # with a sqlite_<name> option
+    PRAGMAS = (
+               ('busy_timeout', 10000),
+               ('journal_mode', 'WAL'),
+               ('synchronous', 'NORMAL'),
+               ('cache_size', -65536),
+               ('mmap_size', 268435456),
+               ('temp_store', 'MEMORY'),
+               )
+
+    # "posts" changes when posts are added and "purges" when they are deleted
+    COUNTERS = ('posts', 'purges', 'tags')
+
+    # rewrite the index file after this fraction of the posts changed
+    INDEX_SAVE_RATIO = 0.1
+
+    # posts deleted and ids checked for orphan images and tags per transaction
+    PURGE_BATCH = 1000
+    PURGE_WINDOW = 10000
+
+    # search terms that can't be answered by the tag index
+    FILTER_KEYS = ('width', 'height', 'rating', 'pool', 'ratio')
+
+    def __init__(self, dbname="", tag_cache_size=None, pragmas=None, shared=None):
+        '''With shared, the engine, caches and tag index of that database are
+        used instead of opening the file again. Only the board is kept apart,
+        so the callers must not use both at the same time.'''
+        self.dbname = dbname
+        if shared:
+            self.dbname = shared.dbname
+            self.engine = shared.engine
+            self.DBsession = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=self.engine))
+            self.tag_cache = shared.tag_cache
+            self.query_cache = shared.query_cache
+            self.tag_index = shared.tag_index
+            self._index_lock = shared._index_lock
+            self.index_path = shared.index_path
+            return
 
-        # enable foreign key support on sqlite
-        def _fk_pragma_on_connect(dbapi_con, con_record):  # @UnusedVariable
+        # prepare the engine, the connections of a file database are kept
+        # open so their page cache and mapping survive the transactions.
+        # Every session still uses a connection from one thread at a time.
+        if dbname and dbname != ':memory:':
+            self.engine = create_engine("sqlite:///%s" % dbname, poolclass=QueuePool,
+                                        connect_args={'check_same_thread': False})
+        else:
+            self.engine = create_engine("sqlite:///%s" % dbname)
+
+        values = dict(self.PRAGMAS)
+        if pragmas:
+            values.update(pragmas)
+        for name, value in values.items():
+            if not re.match(r'^-?\w+$', str(value)):
+                raise DanbooruError('Invalid value for sqlite_%s: %s' % (name, value))
+        pragma_list = [(name, values[name]) for name, _ in self.PRAGMAS]
+
+        # enable foreign key support on sqlite and tune the connection
+        def _pragmas_on_connect(dbapi_con, con_record):  # @UnusedVariable
             dbapi_con.execute('pragma foreign_keys=ON')
-        event.listen(self.engine, 'connect', _fk_pragma_on_connect)
+            for name, value in pragma_list:
+                dbapi_con.execute('pragma %s=%s' % (name, value))
+        event.listen(self.engine, 'connect', _pragmas_on_connect)
 
-        # create the tables
+        # create the tables and update the existing ones
         Base.metadata.create_all(bind=self.engine)  # @UndefinedVariable
+        migrate(self.engine)
 
         # create a session
         self.DBsession = scoped_session(
@@ -48,6 +119,60 @@ class Database(object):
             )
         )
 
+        self._initCounters()
+
+        self.tag_cache = TagCache(tag_cache_size)
+        self.query_cache = QueryCache()
+        self.warmTagCache()
+
+        # mapped from the file next to the database or built on the first
+        # search
+        self.tag_index = TagIndex()
+        self._index_lock = Lock()
+        self.index_path = None
+        if dbname and dbname != ':memory:':
+            self.index_path = dbname + '.tagindex'
+            self.tag_index.load(self.index_path)
+
+    def _initCounters(self):
+        s = self.DBsession()
+        missing = set(self.COUNTERS) - set(self.getCounters(s))
+        if missing:
+            for name in missing:
+                s.execute(Counter.__table__.insert().prefix_with('OR IGNORE'), {'name': name, 'value': 0})
+            s.commit()
+
+    def getCounters(self, session=None):
+        s = session or self.DBsession()
+        return dict(s.query(Counter.name, Counter.value))
+
+    def _lockCounters(self, session):
+        '''Starts the write transaction with a no-op update of the counters,
+        no other connection can change them until it ends. Returns them.'''
+        q = Counter.__table__.update().where(Counter.name == 'tags')
+        session.execute(q.values(value=Counter.value))
+        return self.getCounters(session)
+
+    def _bumpCounter(self, session, name):
+        q = Counter.__table__.update().where(Counter.name == name)
+        session.execute(q.values(value=Counter.value + 1))
+
+    @classmethod
+    def configPragmas(cls, cfg):
+        '''Returns the pragmas overridden in the loaded settings.'''
+        pragmas = {}
+        for name, _ in cls.PRAGMAS:
+            value = getattr(cfg, 'sqlite_' + name, None)
+            if value:
+                pragmas[name] = value
+        return pragmas
+
+    def warmTagCache(self):
+        s = self.DBsession()
+        # read before the tags, a purge in between clears them on next use
+        self.tag_cache.validate(self.getCounters(s)['tags'])
+        self.tag_cache.update(s.query(Tag.name, Tag.id).limit(self.tag_cache.max_size))
+
     def _cleanDict(self, model, post):
         clean = [x.name for x in model.__mapper__.columns]
         return {key: value for key, value in post.items() if key in clean}
@@ -112,41 +237,109 @@ class Database(object):
         self.board = board
         return True
 
-    def savePosts(self, posts):
-        results = {'tags': 0, 'images': 0, 'posts': 0}
-        s = self.DBsession()
-
-        for post in posts:
-            if 'file_url' not in post:
-                continue
-            #fix file extension
-            defaults = {'file_ext': os.path.splitext(post['file_url'])[1]}
-            if defaults['file_ext'] == ".jpeg":
-                defaults['file_ext'] = ".jpg"
-
-            clean_image = self._cleanDict(Image, post)
-            defaults.update(clean_image)
+    def _chunks(self, items):
+        items = list(items)
+        for i in range(0, len(items), self.IN_CHUNK_SIZE):
+            yield items[i:i + self.IN_CHUNK_SIZE]
+
+    def _cleanRow(self, model, post):
+        # every row of an executemany needs the same set of keys
+        row = dict((x.name, None) for x in model.__table__.columns
+                   if x.name != 'id' and x.default is None)
+        row.update((key, value) for key, value in post.items() if key in row)
+        return row
+
+    def _mapIds(self, session, model, key, values, *criterion):
+        column = getattr(model, key)
+        ids = {}
+        for chunk in self._chunks(values):
+            q = session.query(column, model.id).filter(column.in_(chunk), *criterion)
+            ids.update(q)
+        return ids
+
+    def _insertMissing(self, session, model, key, rows, ids, *criterion):
+        missing = [row for value, row in rows.items() if value not in ids]
+        if missing:
+            session.execute(model.__table__.insert(), missing)
+            ids.update(self._mapIds(session, model, key, [row[key] for row in missing], *criterion))
+        return len(missing)
+
+    def _getTagIds(self, session, names):
+        ids, missing = self.tag_cache.lookup(names)
+        if missing:
+            found = self._mapIds(session, Tag, 'name', missing)
+            self.tag_cache.update(found.items())
+            ids.update(found)
+        return ids
 
-            img, created = self._getOrCreate(s, Image, defaults, **{'md5': post['md5']})
-            results['images'] += int(created)
-
-            tags = [self._getOrCreate(s, Tag, **{'name': v}) for v in post['tags']]
-            results['tags'] += sum(created for tag, created in tags)
-
-            defaults = {'image': img, 'tags': [tag for tag, created in tags]}
-            clean_post = self._cleanDict(Post, post)
-            defaults.update(clean_post)
-
-            # avoid search by post_id
-            del defaults['post_id']
+    def savePosts(self, posts):
+        posts = [post for post in posts if 'file_url' in post]
+        if not posts:
+            return {'tags': 0, 'images': 0, 'posts': 0}
 
-            new_post, created = self._getOrCreate(s, Post, defaults, **{'post_id': post['post_id'], 'board': self.board})
-            results['posts'] += int(created)
+        s = self.DBsession()
+        try:
+            return self._savePosts(s, posts)
+        except Exception:
+            # leave the session usable for the next page
+            s.rollback()
+            raise
+
+    def _savePosts(self, s, posts):
+        results = {'tags': 0, 'images': 0, 'posts': 0}
+        # the tags cached before another process deleted them can be gone
+        self.tag_cache.validate(self._lockCounters(s)['tags'])
 
-            s.add(new_post)
-            s.flush()
+        board_id = self.board.id if self.board else None
 
+        # gather the distinct images, tags and posts of the page, the first
+        # occurrence wins as it did when they were created one by one
+        images = {}
+        tags = {}
+        new_posts = {}
+        for post in posts:
+            if post['md5'] not in images:
+                image = self._cleanRow(Image, post)
+                #fix file extension
+                file_ext = os.path.splitext(post['file_url'])[1]
+                if file_ext == ".jpeg":
+                    file_ext = ".jpg"
+                if not image['file_ext']:
+                    image['file_ext'] = file_ext
+                images[post['md5']] = image
+            for name in post['tags']:
+                tags.setdefault(name, {'name': name})
+            new_posts.setdefault(post['post_id'], post)
+
+        image_ids = self._mapIds(s, Image, 'md5', images.keys())
+        results['images'] = self._insertMissing(s, Image, 'md5', images, image_ids)
+
+        tag_ids, missing = self.tag_cache.lookup(tags.keys())
+        new_tags = self._mapIds(s, Tag, 'name', missing)
+        results['tags'] = self._insertMissing(s, Tag, 'name', dict((name, tags[name]) for name in missing), new_tags)
+        tag_ids.update(new_tags)
+
+        # existing posts are left untouched
+        post_ids = self._mapIds(s, Post, 'post_id', new_posts.keys(), Post.board_id == board_id)
+        rows = {}
+        for post_id, post in new_posts.items():
+            if post_id not in post_ids:
+                row = self._cleanRow(Post, post)
+                row['image_id'] = image_ids[post['md5']]
+                row['board_id'] = board_id
+                rows[post_id] = row
+        results['posts'] = self._insertMissing(s, Post, 'post_id', rows, post_ids, Post.board_id == board_id)
+
+        links = [{'tag_id': tag_ids[name], 'post_id': post_ids[post_id]}
+                 for post_id in rows for name in set(new_posts[post_id]['tags'])]
+        if links:
+            s.execute(association_table__tag_post.insert(), links)
+
+        if results['posts']:
+            self._bumpCounter(s, 'posts')
         s.commit()
+        # only cache the ids once they are committed
+        self.tag_cache.update(new_tags.items())
         return results
 
     def savePools(self, pools):
@@ -199,70 +392,341 @@ class Database(object):
     def fileExists(self, md5):
         return bool(self.DBsession().query(Image).filter_by(md5=md5).first())
 
-    #FIXME: unused?
-    def getORPosts(self, tags, limit):
-        q = self.DBsession().query(Post).join(Post.tags)
-        q = q.filter(Tag.name.in_(tags)).group_by(Post.image_id)
-        q = q.order_by(Post.post_id.desc())
-        return q.limit(limit).all()
-
-    def getANDPosts(self, tags, limit=100, extra_items=None):
-        q = self.DBsession().query(Post).join(Post.tags)
-        if extra_items:
-            q = self._dict2ToQuery(q, extra_items)
+    def getMD5s(self):
+        '''Returns the set of md5 of every image.'''
+        return set(x for x, in self.DBsession().execute(select([Image.md5])))
+
+    def _syncIndex(self, session):
+        index = self.tag_index
+        # read the counters first, anything committed after that is caught
+        # up on the next search
+        counters = self.getCounters(session)
+        self.tag_cache.validate(counters['tags'])
+        if counters == index.counters:
+            return
+        if not index.counters or counters['purges'] != index.counters['purges']:
+            logging.debug("Building the tag index")
+            index.clear()
+        self._loadIndex(session, index.max_post_id)
+        index.counters = counters
+        self._saveIndex()
+
+    def _saveIndex(self):
+        index = self.tag_index
+        if not self.index_path or index.unsaved <= len(index) * self.INDEX_SAVE_RATIO:
+            return
+        index.optimize()
+        try:
+            index.save(self.index_path)
+        except (IOError, OSError) as e:
+            logging.warning("Can't save the tag index: %s", e)
+
+    def _loadIndex(self, session, after_id):
+        index = self.tag_index
+        q = select([Post.id, Post.post_id, Post.image_id, Post.board_id])
+        q = q.where(Post.id > after_id).order_by(Post.id)
+        for row in session.execute(q):
+            index.addPost(*row)
+
+        # skip the tags of posts inserted after the query above
+        tag_post = association_table__tag_post
+        q = select([tag_post.c.tag_id, tag_post.c.post_id])
+        q = q.where(tag_post.c.post_id <= index.max_post_id)
+        if after_id:
+            q = q.where(tag_post.c.post_id > after_id).order_by(tag_post.c.post_id)
+        else:
+            q = q.order_by(tag_post.c.tag_id, tag_post.c.post_id)
+        for tag_id, post_id in session.execute(q):
+            index.addTag(tag_id, post_id)
+
+    def _filterIds(self, session, ids, items):
+        if not any(items.get(key) for key in self.FILTER_KEYS):
+            return ids
+        found = set()
+        for chunk in self._chunks(ids):
+            q = self._dict2ToQuery(session.query(Post.id).filter(Post.id.in_(chunk)), items)
+            found.update(x for x, in q)
+        return [x for x in ids if x in found]
+
+    def _rowsQuery(self, session):
+        return session.query(Post.id, Post.post_id, Post.board_id, Post.image_id, Post.file_url,
+                             Image.md5, Image.file_ext, Image.file_size).join(Post.image)
+
+    def getPostRows(self, ids):
+        '''Returns the PostRow of the posts with the given ids in the same
+        order, skipping the ones that no longer exist.'''
+        s = self.DBsession()
+        rows = {}
+        for chunk in self._chunks(ids):
+            rows.update((x[0], PostRow(*x)) for x in self._rowsQuery(s).filter(Post.id.in_(chunk)))
+        return [rows[x] for x in ids if x in rows]
+
+    def getPostDetails(self, ids):
+        '''Returns a dict with the PostDetails of every post, the tags and
+        pools of all of them are read with one query per chunk of ids.'''
+        s = self.DBsession()
+        tag_post = association_table__tag_post.c
+        pool_post = association_table__pool_post.c
+        details = {}
+        for chunk in self._chunks(ids):
+            tags = dict((x, []) for x in chunk)
+            q = s.query(tag_post.post_id, Tag.name).filter(Tag.id == tag_post.tag_id, tag_post.post_id.in_(chunk))
+            for post_id, name in q.order_by(Tag.name):
+                tags[post_id].append(name)
+            pools = dict((x, []) for x in chunk)
+            q = s.query(pool_post.post_id, Pool.pool_id, Pool.name)
+            q = q.filter(Pool.id == pool_post.pool_id, pool_post.post_id.in_(chunk))
+            for post_id, pool_id, name in q.order_by(Pool.pool_id):
+                pools[post_id].append((pool_id, name))
+            q = s.query(Post.id, Post.post_id, Post.rating, Post.score, Image.width, Image.height, Board.host)
+            q = q.join(Post.image).outerjoin(Post.board).filter(Post.id.in_(chunk))
+            for row in q:
+                details[row[0]] = PostDetails(*row, tags=tags[row[0]], pools=pools[row[0]])
+        return details
+
+    def _searchIds(self, session, tags, extra_items):
+        include, any_groups, exclude = split_tags(tags)
+        tag_ids = self._getTagIds(session, set(include).union(exclude, *any_groups))
+        if not all(name in tag_ids for name in include):
+            # at least one of the tags doesn't exist
+            return []
+        groups = [[tag_ids[name] for name in group if name in tag_ids] for group in any_groups]
+        if not all(groups):
+            return []
+
+        index = self.tag_index
+        ids = index.search([tag_ids[name] for name in include], groups,
+                           [tag_ids[name] for name in exclude if name in tag_ids])
         if self.board:
-            q = q.filter(Post.board == self.board)
-        q = q.filter(Tag.name.in_(tags)).group_by(Post.image_id)
-        q = q.having(func.count(distinct(Tag.name)) == len(tags))
-        q = q.order_by(Post.post_id.desc())
-        if limit:
-            q = q.limit(limit)
-        return q.all()
-
-    def getPosts(self, limit=100, offset=0, extra_items=None):
-        q = self.DBsession().query(Post)
+            ids = index.filterBoard(ids, self.board.id)
         if extra_items:
-            q = self._dict2ToQuery(q, extra_items)
-        q = q.order_by(Post.post_id.desc())
-        return q.limit(limit).offset(offset).all()
+            ids = self._filterIds(session, ids, extra_items)
+        return ids
+
+    def getPostIds(self, tags=None, extra_items=None, blacklist=None, whitelist=None):
+        '''Returns the ids of the posts with the tags searched in the tag
+        index, newest first, or of all the posts of the board without tags.
+        Besides the required tags, "-tag" excludes a tag and "~tag" or
+        "tag1|tag2" require any of them. The posts with any blacklisted tag
+        and no whitelisted one are left out. The results are cached until the
+        posts change.'''
+        s = self.DBsession()
+        key = self._queryKey(tags, extra_items, blacklist, whitelist)
+        with self._index_lock:
+            self._syncIndex(s)
+            # the counters change with every save or purge of posts, also
+            # when they are done by another process
+            self.query_cache.validate(tuple(sorted(self.tag_index.counters.items())))
+            ids = self.query_cache.get(key)
+            if ids is None:
+                ids = self._searchPostIds(s, tags, extra_items, blacklist, whitelist)
+                self.query_cache.set(key, array('I', ids))
+                return ids
+        return list(ids)
+
+    def getANDPosts(self, tags, limit=100, extra_items=None):
+        '''Returns the PostRow of the first limit posts found by
+        getPostIds.'''
+        return self.getPostRows(self.getPostIds(tags, extra_items)[:limit])
 
-    def getPools(self, limit=100, offset=0, extra_items=None):
+    def getORPosts(self, tags, limit):
+        '''Returns the PostRow of the first limit posts with any of the
+        tags.'''
+        if not tags:
+            return []
+        return self.getPostRows(self.getPostIds(['~' + x for x in tags])[:limit])
+
+    def iterPosts(self, limit=100, extra_items=None):
+        '''Yields lists of up to limit PostRow with all the posts of the
+        board in the order of getPostIds.'''
+        ids = self.getPostIds(extra_items=extra_items)
+        for start in range(0, len(ids), limit):
+            yield self.getPostRows(ids[start:start + limit])
+
+    def _queryKey(self, tags, extra_items, blacklist, whitelist):
+        # the order and repetitions of the terms don't change the results
+        include, any_groups, exclude = split_tags(tags or [])
+        items = tuple(sorted((k, v) for k, v in (extra_items or {}).items() if k != 'tags'))
+        return (frozenset(include), frozenset(frozenset(group) for group in any_groups),
+                frozenset(exclude), self.board.id if self.board else None, items,
+                frozenset(blacklist or []), frozenset(whitelist or []))
+
+    def _searchPostIds(self, session, tags, extra_items, blacklist, whitelist):
+        black_ids = self._getTagIds(session, blacklist) if blacklist else {}
+        white_ids = self._getTagIds(session, whitelist) if black_ids and whitelist else {}
+        if tags:
+            ids = self.tag_index.top(self._searchIds(session, tags, extra_items))
+        else:
+            q = session.query(Post.id)
+            if self.board:
+                q = q.filter(Post.board_id == self.board.id)
+            if extra_items:
+                q = self._dict2ToQuery(q, extra_items)
+            ids = [x for x, in q.order_by(Post.post_id.desc(), Post.id.desc())]
+        if black_ids:
+            hidden = set(self.tag_index.search([], [list(black_ids.values())], white_ids.values()))
+            ids = [x for x in ids if x not in hidden]
+        return ids
+
+    def iterPools(self, limit=100, extra_items=None):
+        '''Yields lists of up to limit modified pools ordered by update
+        time, continuing from the (updated_at, id) of the last one.'''
         q = self.DBsession().query(Pool).filter_by(modified=True)
         if extra_items:
             q = self._dict2ToQuery(q, extra_items)
-        q = q.order_by(Pool.updated_at.asc())
-        return q.limit(limit).offset(offset).all()
-
-    def getFiles(self, limit, offset):
-        q = self.DBsession().query(Post).join(Post.image)
-        if self.board:
-            q = q.filter(Post.board == self.board)
-        q = q.options(joinedload('image'))
-        return q.limit(limit).offset(offset).all()
+        # sqlite sorts the pools without update time first
+        last_id = 0
+        while True:
+            rows = q.filter(Pool.updated_at == None, Pool.id > last_id).order_by(Pool.id).limit(limit).all()
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1].id
+
+        q = q.filter(Pool.updated_at != None).order_by(Pool.updated_at, Pool.id)
+        last = None
+        while True:
+            page = q
+            if last:
+                page = q.filter(or_(Pool.updated_at > last.updated_at,
+                                    and_(Pool.updated_at == last.updated_at, Pool.id > last.id)))
+            rows = page.limit(limit).all()
+            if not rows:
+                break
+            yield rows
+            last = rows[-1]
+
+    def iterFiles(self, limit=2048, nohash=False):
+        '''Yields lists of PostRow with one post for every image of the board
+        that wasn't downloaded (or checked unless nohash) yet. The images
+        are walked by state and id on the download state index, so only the
+        pending ones are read.'''
+        s = self.DBsession()
+        required = Image.DOWNLOADED if nohash else Image.VERIFIED
+        for state in range(Image.PENDING, required):
+            last_id = 0
+            while True:
+                q = s.query(Image.id).filter(Image.download_state == state, Image.id > last_id)
+                image_ids = [x for x, in q.order_by(Image.id).limit(limit)]
+                if not image_ids:
+                    break
+                last_id = image_ids[-1]
+                posts = {}
+                for chunk in self._chunks(image_ids):
+                    # the board is checked here, sqlite would rather scan
+                    # all its posts than look up the images
+                    q = self._rowsQuery(s).filter(Post.image_id.in_(chunk))
+                    for post in q.order_by(Post.id):
+                        if not self.board or post.board_id == self.board.id:
+                            posts.setdefault(post.image_id, PostRow(*post))
+                if posts:
+                    yield [posts[x] for x in image_ids if x in posts]
+
+    def iterImages(self, limit=1024, newest=False, after_id=None):
+        '''Yields lists of up to limit images ordered by id, the newest
+        first if asked. With after_id only the images added after it are
+        read.'''
+        q = self.DBsession().query(Image)
+        if after_id:
+            q = q.filter(Image.id > after_id)
+        if newest:
+            q = q.order_by(Image.id.desc())
+        else:
+            q = q.order_by(Image.id)
+        last_id = None
+        while True:
+            if last_id is None:
+                rows = q.limit(limit).all()
+            elif newest:
+                rows = q.filter(Image.id < last_id).limit(limit).all()
+            else:
+                rows = q.filter(Image.id > last_id).limit(limit).all()
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1].id
+
+    def setDownloadStates(self, states):
+        '''Saves the (image id, state, size, mtime) tuples reported by the
+        downloader.'''
+        if not states:
+            return
+        s = self.DBsession()
+        table = Image.__table__
+        q = table.update().where(table.c.id == bindparam('image_id'))
+        q = q.values(download_state=bindparam('state'), download_size=bindparam('size'),
+                     download_mtime=bindparam('mtime'))
+        s.execute(q, [{'image_id': image_id, 'state': state, 'size': size, 'mtime': mtime}
+                      for image_id, state, size, mtime in states])
+        s.commit()
 
-    def deletePostsByTags(self, blacklist, whitelist):
+    def deletePostsByTags(self, blacklist, whitelist, callback=None):
+        '''Deletes the posts with any blacklisted tag and no whitelisted one,
+        then the images and tags left without posts. Every batch is committed
+        on its own so other readers and writers aren't blocked for long, the
+        progress is reported with callback(stage, current, total).'''
         if not blacklist:
-            return 0
+            return (0, 0, 0)
 
         s = self.DBsession()
-
-        subq = s.query(Post.id).distinct().join(Post.tags)
-        subq = subq.filter(Tag.name.in_(whitelist))
-
-        q = s.query(Post.id).distinct().join(Post.tags)
-        q = q.filter(Tag.name.in_(blacklist)).except_(subq)
-
-        d = s.query(Post).filter(Post.id.in_(q))
-        post_count = d.delete(synchronize_session='fetch')
-
-        # delete the image refs without posts from the database
-        q = s.query(Post.image_id).distinct()
-        d = s.query(Image.id).filter(not_(Image.id.in_(q)))
-        img_count = d.delete(synchronize_session='fetch')
-
-        q = s.query(Tag.id).join(Post.tags)
-        d = s.query(Tag.id).filter(not_(Tag.id.in_(q)))
-        tag_count = d.delete(synchronize_session='fetch')
-
-        s.commit()
+        post_ids = []
+        with self._index_lock:
+            # the tag cache is checked by the sync
+            self._syncIndex(s)
+            black_ids = self._getTagIds(s, blacklist)
+            white_ids = self._getTagIds(s, whitelist or [])
+            if black_ids:
+                post_ids = self.tag_index.search([], [list(black_ids.values())], white_ids.values())
+
+        table = Post.__table__
+        post_count = 0
+        for i in range(0, len(post_ids), self.PURGE_BATCH):
+            chunk = post_ids[i:i + self.PURGE_BATCH]
+            with self._index_lock:
+                counters = self.getCounters(s)
+                # tag_post and pool_post rows go away with the foreign keys
+                post_count += s.execute(table.delete().where(table.c.id.in_(chunk))).rowcount
+                self._bumpCounter(s, 'purges')
+                s.commit()
+                self._removeFromIndex(s, counters, chunk)
+            if callback:
+                callback('posts', i + len(chunk), len(post_ids))
+
+        img_count = self._deleteOrphans(s, Image.__table__, Post.__table__.c.image_id, 'images', callback)
+        # the ids of the deleted tags can be reused, the counter tells every
+        # process to drop its cached ids
+        tag_count = self._deleteOrphans(s, Tag.__table__, association_table__tag_post.c.tag_id, 'tags',
+                                        callback, counter='tags')
         return (post_count, img_count, tag_count)
+
+    def _removeFromIndex(self, session, counters, post_ids):
+        # update the index unless someone else changed the posts meanwhile
+        # or sqlite could give the deleted ids to new posts
+        index = self.tag_index
+        if index.counters != counters:
+            return
+        counters = dict(counters, purges=counters['purges'] + 1)
+        last_id = session.query(func.max(Post.id)).scalar() or 0
+        if self.getCounters(session) == counters and all(x < last_id for x in post_ids):
+            index.removePosts(post_ids)
+            index.counters = counters
+            self._saveIndex()
+
+    def _deleteOrphans(self, session, table, column, stage, callback, counter=None):
+        '''Deletes the rows of the table not referenced by the column, going
+        through windows of PURGE_WINDOW ids in their own transactions. The
+        counter is bumped by the windows that deleted something.'''
+        last_id = session.execute(select([func.max(table.c.id)])).scalar() or 0
+        orphan = not_(exists().where(column == table.c.id))
+        count = 0
+        for start in range(0, last_id, self.PURGE_WINDOW):
+            end = min(start + self.PURGE_WINDOW, last_id)
+            q = table.delete().where(and_(table.c.id > start, table.c.id <= end, orphan))
+            deleted = session.execute(q).rowcount
+            if deleted and counter:
+                self._bumpCounter(session, counter)
+            count += deleted
+            session.commit()
+            if callback:
+                callback(stage, end, last_id)
+        return count
@@ -15,14 +15,77 @@
 #   limitations under the License.
 
 import sys
-import socket
+import stat
 import hashlib
 import logging
 from time import sleep
-from os.path import isfile, join, getsize
-from urllib.request import urlopen
-from urllib.error import URLError, HTTPError
-from http.client import HTTPException
+from threading import BoundedSemaphore, Lock, Event
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, remove, replace, stat as os_stat
+from os.path import isfile, getsize, dirname
+from urllib.parse import urlparse
+
+from danbooru.connection import ConnectionPool
+from danbooru.error import DanbooruError, HTTPStatusError
+from danbooru.models import Image
+from danbooru.utils import image_path
+from danbooru.verify import file_md5, file_hash
+from danbooru.ratelimit import get_bucket, retry_after
+
+
+class HostSlots(object):
+    '''Limits the connections to a host and the rate of its requests'''
+
+    def __init__(self, connections, bucket):
+        self.connections = connections
+        self.bucket = bucket
+        self._semaphore = BoundedSemaphore(connections)
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        self.bucket.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._semaphore.release()
+
+
+_slots = {}
+_slots_lock = Lock()
+
+
+def get_slots(host, connections, bucket):
+    '''Returns the slots shared by every downloader of the host, the first
+    connection limit is kept.'''
+    with _slots_lock:
+        slots = _slots.get(host)
+        if not slots:
+            slots = _slots[host] = HostSlots(connections, bucket)
+        elif slots.connections != connections:
+            logging.warning("Keeping %i connections to %s, ignoring %i",
+                            slots.connections, host, connections)
+        return slots
+
+
+# md5 of the images being downloaded by any section of the process, they
+# would write to the same partial file
+_downloads = {}
+_downloads_lock = Lock()
+
+
+def claim_file(md5):
+    '''Claims the download of an image for the calling thread. Returns None
+    if it got it, otherwise the event set once the owner releases it.'''
+    with _downloads_lock:
+        event = _downloads.get(md5)
+        if event is None:
+            _downloads[md5] = Event()
+        return event
+
+
+def release_file(md5):
+    with _downloads_lock:
+        _downloads.pop(md5).set()
 
 
 class Downloader(object):
@@ -30,108 +93,194 @@ class Downloader(object):
     _total = 1
     _stop = False
 
-    def __init__(self, path):
+    def __init__(self, path, workers=1, host_connections=2, rate=1, burst=1, pool=None):
         self.path = path
+        self.pool = pool or ConnectionPool()
+        self.workers = workers
+        self.host_connections = host_connections
+        self.rate = rate
+        self.burst = burst
+        self._lock = Lock()
 
     def stop(self):
         logging.debug("Stopping download job")
         self._stop = True
 
+    def _hostSlots(self, url):
+        # the sections of the daemon download from the same hosts, the limits
+        # apply to all of them together
+        host = urlparse(url).netloc
+        # file requests don't count against the API rate of the host
+        bucket = get_bucket((host, 'files'), self.rate, self.burst)
+        return get_slots(host, self.host_connections, bucket)
+
     def _calculateMD5(self, name):
+        return file_md5(name)
+
+    def _rangeStart(self, meta):
+        # Content-Range: bytes <start>-<end>/<size>
         try:
-            file = open(name, 'rb')
-            md5_hash = hashlib.md5()
-            while True:
-                d = file.read(128)
-                if not d:
-                    break
-                md5_hash.update(d)
-            file.close()
-            return md5_hash.hexdigest()
-        except IOError:
-            pass
+            return int(meta['Content-Range'].split()[1].split('-')[0])
+        except (AttributeError, IndexError, ValueError):
+            return -1
+
+    def _checkFile(self, dl, filename, nohash):
+        '''Returns the download state of the file on disk, None if it has to
+        be downloaded.'''
+        try:
+            st = os_stat(filename)
+        except OSError:
+            #logging.warning("%s doesn't exists, re-downloading", filename)
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        if dl.file_size and st.st_size != dl.file_size:
+            logging.warning("%s filesize doesn't match, re-downloading", filename)
+            return None
+        if nohash:
+            return Image.DOWNLOADED
+        md5 = self._calculateMD5(filename)
+        if md5:
+            if md5 == dl.md5:
+                #logging.debug("%s already exists, skipping" % filename)
+                return Image.VERIFIED
+            logging.warning("%s md5sum doesn't match, re-downloading", filename)
+        return None
+
+    def _state(self, dl, filename, state):
+        st = os_stat(filename)
+        return (dl.image_id, state, st.st_size, st.st_mtime)
 
     def downloadQueue(self, dl_list, nohash=False, callback=None):
+        '''Downloads the images of the posts, returns the (image id, state,
+        size, mtime) of the files that are complete.'''
+        # posts sharing an image only fetch it once
+        images = {}
         for dl in dl_list:
+            images.setdefault(dl.md5, dl)
+        dl_list = list(images.values())
+
+        def download(dl):
+            return self.downloadFile(dl, nohash, callback)
+
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # consume the results so the worker exceptions are raised here
+                states = list(executor.map(download, dl_list))
+        else:
+            states = []
+            for dl in dl_list:
+                if self._stop:
+                    break
+                states.append(download(dl))
+        return [state for state in states if state]
+
+    def downloadFile(self, dl, nohash=False, callback=None):
+        '''Returns the (image id, state, size, mtime) of the file once it
+        is on disk, None otherwise.'''
+        while True:
             if self._stop:
+                return None
+            busy = claim_file(dl.md5)
+            if busy is None:
                 break
-            base = dl.image.md5 + dl.image.file_ext
-
-            subdir = dl.image.md5[0]
-            filename = join(self.path, subdir, base)
-            if isfile(filename):
-                if not dl.image.file_size or getsize(filename) == dl.image.file_size:
-                    if nohash:
-                        continue
-                    else:
-                        md5 = self._calculateMD5(filename)
-                        if md5:
-                            if md5 == dl.image.md5:
-                                #logging.debug("%s already exists, skipping" % filename)
-                                continue
-                            else:
-                                logging.warning("%s md5sum doesn't match, re-downloading", filename)
-                else:
-                    logging.warning("%s filesize doesn't match, re-downloading", filename)
-            #else:
-            #    logging.warning("%s doesn't exists, re-downloading", filename)
-            try:
-                local_file = open(filename, 'wb')
-            except IOError:
-                logging.error('Error while creating %s', filename)
-                continue
+            # another section is getting the same image, check the file
+            # once it is done
+            busy.wait(1)
+        try:
+            return self._downloadFile(dl, nohash, callback)
+        finally:
+            release_file(dl.md5)
 
-            retries = 0
-            start = 0
+    def _downloadFile(self, dl, nohash, callback):
+        base = dl.md5 + dl.file_ext
+        filename = image_path(self.path, dl.md5, dl.file_ext)
+        state = self._checkFile(dl, filename, nohash)
+        if state is not None:
+            return self._state(dl, filename, state)
 
-            while not self._stop and retries < 3:
-                try:
-                    remote_file = urlopen(dl.file_url)
+        makedirs(dirname(filename), exist_ok=True)
+        # incomplete downloads are kept aside so they can be resumed later
+        part_name = filename + '.part'
+        retries = 0
+        host = self._hostSlots(dl.file_url)
 
+        while not self._stop and retries < 3:
+            start = getsize(part_name) if isfile(part_name) else 0
+            headers = {'Range': 'bytes=%i-' % start} if start else None
+            try:
+                # ranges refer to the stored bytes, don't ask for compression
+                with host, self.pool.request(dl.file_url, headers, compress=False) as remote_file:
                     meta = remote_file.info()
+
+                    if start and remote_file.getcode() == 206 and self._rangeStart(meta) == start:
+                        logging.debug('Resuming %s from byte %i', base, start)
+                        mode = 'ab'
+                        # the hash also covers the bytes of the previous runs
+                        md5_hash = file_hash(part_name)
+                    else:
+                        if start:
+                            logging.debug('Cannot resume %s, starting over', base)
+                        start = 0
+                        mode = 'wb'
+                        md5_hash = hashlib.md5()
+
                     if "Content-Length" in meta:
-                        remote_size = int(meta['Content-Length'])
+                        remote_size = start + int(meta['Content-Length'])
                     else:
                         remote_size = -1
 
-                    if start:
-                        remote_file.seek(start)
+                    with open(part_name, mode) as local_file:
+                        while not self._stop:
+                            buf = remote_file.read(16 * 1024)
+                            if not buf:
+                                break
+                            local_file.write(buf)
+                            md5_hash.update(buf)
+                            start += len(buf)
+                            if callback:
+                                callback(base, start, remote_size)
 
-                    while not self._stop:
-                        buf = remote_file.read(16 * 1024)
-                        if not buf:
-                            break
-                        local_file.write(buf)
-                        start += len(buf)
-                        if callback:
-                            callback(base, start, remote_size)
+                if callback:
+                    sys.stdout.write("\r")
+                    sys.stdout.flush()
 
-                    remote_file.close()
-                    local_file.close()
+                if self._stop:
+                    logging.debug('(%i) %s [ABORTED]', self._total, base)
+                    break
+
+                if remote_size >= 0 and start != remote_size:
+                    raise DanbooruError("Got %i of %i bytes" % (start, remote_size))
 
-                    if callback:
-                        sys.stdout.write("\r")
-                        sys.stdout.flush()
+                host.bucket.success()
+                if ((dl.file_size and start != dl.file_size) or
+                        md5_hash.hexdigest() != dl.md5):
+                    # a corrupt transfer can't be resumed, get it again now
+                    remove(part_name)
+                    retries += 1
+                    logging.warning('%s md5sum doesn\'t match, retrying (%i)', base, retries)
+                    continue
 
-                    if self._stop:
-                        logging.debug('(%i) %s [ABORTED]', self._total, base)
-                        break
+                replace(part_name, filename)
 
+                with self._lock:
                     logging.debug('(%i) %s [OK]', self._total, base)
                     self._total += 1
-                    sleep(1)
-                    break
-                except HTTPError as e:
-                    logging.error('>>> Error %i: %s', e.code, e.msg)
-                except URLError as e:
-                    logging.error('>>> Error %s', e.reason)
-                except HTTPException as e:
-                    logging.error('>>> Error HTTPException')
-                except socket.error as e:
-                    logging.error("Connection error: %s", e)
-
-                start = local_file.tell()
-
-                retries += 1
-                logging.warning('Retrying (%i) in 2 seconds...', retries)
-                sleep(2)
+                # checked while it was written, it doesn't need to be read again
+                return self._state(dl, filename, Image.VERIFIED)
+            except HTTPStatusError as e:
+                logging.error('>>> %s', e.message)
+                if e.code == 416:
+                    # the partial file is bigger than the remote one
+                    remove(part_name)
+                elif e.code in (429, 503):
+                    delay = host.bucket.backoff(retry_after(e.headers))
+                    logging.warning('Slowing down requests for %.1f seconds', delay)
+            except DanbooruError as e:
+                logging.error('>>> %s', e.message)
+            except IOError as e:
+                logging.error('Error while writing %s: %s', part_name, e)
+
+            retries += 1
+            logging.warning('Retrying (%i) in 2 seconds...', retries)
+            sleep(2)
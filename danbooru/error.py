@@ -22,3 +22,13 @@ class DanbooruError(Exception):
     def message(self):
         '''Returns the first argument used to construct this error.'''
         return self.args[0]
+
+
+class HTTPStatusError(DanbooruError):
+    '''Raised when the server answers with an HTTP error status'''
+
+    def __init__(self, code, msg, headers=None):
+        DanbooruError.__init__(self, "Error %i: %s" % (code, msg))
+        self.code = code
+        self.msg = msg
+        self.headers = headers or {}
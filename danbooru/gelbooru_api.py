@@ -1,23 +1,49 @@
 import danbooru
 
-import xml.dom.minidom
+from xml.etree import ElementTree
+
+from danbooru.error import DanbooruError
 
 
 class GelbooruAPI(danbooru.api.Api):
 
     POST_API = "/index.php?page=dapi&s=post&q=index"
 
-    def __init__(self, host):
-        self.host = host
-        self._delta_time = 0
+    # the xml attributes are strings, convert them like the json api does
+    INT_FIELDS = ('id', 'width', 'height', 'file_size', 'score', 'parent_id',
+                  'creator_id', 'change', 'sample_width', 'sample_height',
+                  'preview_width', 'preview_height')
+
+    def __init__(self, host, pool=None, rate=None, burst=1):
+        danbooru.api.Api.__init__(self, host, None, None, None, pool, rate, burst)
 
     def getPostsPage(self, tag, query, page, limit, blacklist=None, whitelist=None):
         url = "%s%s&tags=%s&pid=%i&limit=%i" % (self.host, self.POST_API, tag, page, limit)
         return self.getPosts(url, query, blacklist, whitelist)
 
-    def getPosts(self, url, query, blacklist, whitelist):
-        data = self._getData(url)
-        dom = xml.dom.minidom.parseString(data)
-        if dom.childNodes:
-            posts = [dict(node.attributes.items()) for node in dom.childNodes[0].childNodes if isinstance(node, xml.dom.minidom.Element)]
-            return self._processPosts(posts, query, blacklist, whitelist)
+    def _convert(self, post):
+        for key in self.INT_FIELDS:
+            if post.get(key):
+                try:
+                    post[key] = int(post[key])
+                except ValueError:
+                    pass
+        return post
+
+    def _iterPosts(self, response):
+        with response:
+            try:
+                depth = 0
+                for event, node in ElementTree.iterparse(response, events=('start', 'end')):
+                    if event == 'start':
+                        if not depth:
+                            root = node
+                        depth += 1
+                        continue
+                    depth -= 1
+                    if depth == 1:
+                        yield self._convert(dict(node.attrib))
+                        # drop the parsed posts to keep the memory bounded
+                        root.clear()
+            except ElementTree.ParseError as ex:
+                raise DanbooruError("Invalid response from %s: %s" % (self.host, ex))
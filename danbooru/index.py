@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import mmap
+import struct
+import logging
+import tempfile
+from array import array
+from bisect import bisect_left
+
+EMPTY = array('I')
+
+# positions of the set bits of every byte
+_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+class Bitmap(object):
+    '''Set of post ids stored as one bit per id, used for the tags that
+    are in a good part of the posts. The data can be a read only buffer
+    (e.g. a slice of the mapped index file), it is copied on the first
+    change.'''
+
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+    @classmethod
+    def fromIds(cls, ids):
+        data = bytearray((ids[-1] >> 3) + 1 if len(ids) else 0)
+        for x in ids:
+            data[x >> 3] |= 1 << (x & 7)
+        return cls(data, len(ids))
+
+    @classmethod
+    def fromInt(cls, value):
+        return cls(value.to_bytes((value.bit_length() + 7) >> 3, 'little'), _count(value))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, x):
+        i = x >> 3
+        return i < len(self.data) and self.data[i] >> (x & 7) & 1 == 1
+
+    def add(self, x):
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+        i = x >> 3
+        if i >= len(self.data):
+            self.data.extend(bytes(i + 1 - len(self.data)))
+        if not self.data[i] >> (x & 7) & 1:
+            self.data[i] |= 1 << (x & 7)
+            self.count += 1
+
+    def toInt(self):
+        return int.from_bytes(self.data, 'little')
+
+    def ids(self):
+        return _bitIds(self.data)
+
+
+def _count(value):
+    return bin(value).count('1')
+
+
+def _bitIds(data):
+    ids = []
+    for i, byte in enumerate(data):
+        if byte:
+            base = i << 3
+            ids.extend(base + bit for bit in _BITS[byte])
+    return ids
+
+
+def _isSet(postings):
+    # bitmaps and the python ints used for the intermediate dense results
+    return isinstance(postings, (Bitmap, int))
+
+
+def _toInt(postings):
+    if isinstance(postings, int):
+        return postings
+    if not isinstance(postings, Bitmap):
+        postings = Bitmap.fromIds(postings)
+    return postings.toInt()
+
+
+def _toBitmap(postings):
+    if isinstance(postings, int):
+        return Bitmap.fromInt(postings)
+    return postings
+
+
+def _length(postings):
+    if isinstance(postings, int):
+        return _count(postings)
+    return len(postings)
+
+
+def toIds(postings):
+    '''Returns the sorted ids of a posting list of any kind.'''
+    if isinstance(postings, int):
+        return _bitIds(postings.to_bytes((postings.bit_length() + 7) >> 3, 'little'))
+    if isinstance(postings, Bitmap):
+        return postings.ids()
+    return list(postings)
+
+
+def _contains(postings, value):
+    i = bisect_left(postings, value)
+    return i < len(postings) and postings[i] == value
+
+
+def intersect(a, b):
+    '''Returns the ids present in both posting lists.'''
+    if _isSet(a) and _isSet(b):
+        return _toInt(a) & _toInt(b)
+    if _isSet(a):
+        a, b = b, a
+    if _isSet(b):
+        b = _toBitmap(b)
+        return [x for x in a if x in b]
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) * 16 < len(b):
+        # few ids against a long list, binary search them
+        return [x for x in a if _contains(b, x)]
+    ids = set(a)
+    return [x for x in b if x in ids]
+
+
+def difference(a, b):
+    '''Returns the ids of a that are not in b.'''
+    if _isSet(a):
+        return _toInt(a) & ~_toInt(b)
+    if _isSet(b):
+        b = _toBitmap(b)
+        return [x for x in a if x not in b]
+    if len(a) * 16 < len(b):
+        return [x for x in a if not _contains(b, x)]
+    ids = set(b)
+    return [x for x in a if x not in ids]
+
+
+def union(lists):
+    lists = list(lists)
+    if any(_isSet(postings) for postings in lists):
+        value = 0
+        for postings in lists:
+            value |= _toInt(postings)
+        return value
+    ids = set()
+    for postings in lists:
+        ids.update(postings)
+    return sorted(ids)
+
+
+class TagIndex(object):
+    '''Inverted index from every tag id to the ids of its posts, kept as
+    sorted arrays or as bitmaps for the tags in more than 1/32 of the posts.
+    It also keeps the columns needed to filter and rank the results by
+    board, remote id and image, indexed by post id.'''
+
+    MAGIC = b'TIDX'
+    VERSION = 1
+    # magic, version, posts and purges counters, max id, sizes of the
+    # columns, of the post list and of the tag directory, directory offset
+    HEADER = struct.Struct('=4sIqqIIIIQ')
+    SPARSE = 0
+    DENSE = 1
+
+    def __init__(self):
+        self._mmap = None
+        self.clear()
+
+    def clear(self):
+        self.postings = {}
+        self.posts = array('I')
+        self.post_ids = array('I')
+        self.image_ids = array('I')
+        self.board_ids = array('I')
+        self.deleted = set()
+        self.max_post_id = 0
+        # counters of the database the index is in sync with
+        self.counters = None
+        # changes not written to the index file
+        self.unsaved = 0
+        self._close()
+
+    def _close(self):
+        if self._mmap:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # still referenced by a result, it is closed when collected
+                pass
+            self._mmap = None
+
+    def __len__(self):
+        return len(self.posts) - len(self.deleted)
+
+    def _writable(self):
+        # the arrays loaded from the file are read only views
+        if not isinstance(self.posts, array):
+            self.posts = array('I', self.posts)
+            self.post_ids = array('I', self.post_ids)
+            self.image_ids = array('I', self.image_ids)
+            self.board_ids = array('I', self.board_ids)
+
+    def addPost(self, id, post_id, image_id, board_id):  # @ReservedAssignment
+        self._writable()
+        if id >= len(self.post_ids):
+            grow = id + 1 - len(self.post_ids)
+            for column in (self.post_ids, self.image_ids, self.board_ids):
+                column.extend(array('I', [0]) * grow)
+        self.post_ids[id] = post_id or 0
+        self.image_ids[id] = image_id or 0
+        self.board_ids[id] = board_id or 0
+        self._insert(self.posts, id)
+        self.deleted.discard(id)
+        self.max_post_id = max(self.max_post_id, id)
+        self.unsaved += 1
+
+    def addTag(self, tag_id, post_id):
+        postings = self.postings.get(tag_id)
+        if postings is None:
+            postings = self.postings[tag_id] = array('I')
+        elif isinstance(postings, Bitmap):
+            postings.add(post_id)
+            return
+        elif not isinstance(postings, array):
+            postings = self.postings[tag_id] = array('I', postings)
+        self._insert(postings, post_id)
+
+    def _insert(self, postings, value):
+        # the ids usually come in ascending order
+        if not postings or postings[-1] < value:
+            postings.append(value)
+        else:
+            i = bisect_left(postings, value)
+            if i == len(postings) or postings[i] != value:
+                postings.insert(i, value)
+
+    def optimize(self):
+        '''Turns the posting lists of the common tags into bitmaps.'''
+        limit = len(self.post_ids) >> 5
+        for tag_id, postings in self.postings.items():
+            if not isinstance(postings, Bitmap) and len(postings) > limit:
+                self.postings[tag_id] = Bitmap.fromIds(postings)
+
+    def removePosts(self, ids):
+        # the deleted ids are filtered from the results until the next rebuild
+        self.deleted.update(ids)
+        self.unsaved += len(ids)
+
+    def get(self, tag_id):
+        return self.postings.get(tag_id, EMPTY)
+
+    def search(self, include, any_groups=(), exclude=()):
+        '''Returns the sorted ids of the posts that have all the include tags,
+        at least one tag of each group of any_groups and none of the exclude
+        tags. The shortest lists are intersected first.'''
+        lists = [self.get(tag_id) for tag_id in include]
+        lists += [union(self.get(tag_id) for tag_id in group) for group in any_groups]
+        if lists:
+            lists.sort(key=_length)
+            result = lists[0]
+            for postings in lists[1:]:
+                if not result:
+                    break
+                result = intersect(result, postings)
+        else:
+            result = self.posts
+
+        for tag_id in exclude:
+            if not result:
+                break
+            result = difference(result, self.get(tag_id))
+        result = toIds(result)
+        if self.deleted:
+            result = [x for x in result if x not in self.deleted]
+        return result
+
+    def filterBoard(self, ids, board_id):
+        board_ids = self.board_ids
+        return [x for x in ids if board_ids[x] == board_id]
+
+    def top(self, ids, limit=None):
+        '''Returns the ids ordered by descending remote id, keeping one post
+        per image.'''
+        post_ids = self.post_ids
+        image_ids = self.image_ids
+        images = set()
+        result = []
+        for x in sorted(ids, key=post_ids.__getitem__, reverse=True):
+            if image_ids[x] not in images:
+                images.add(image_ids[x])
+                result.append(x)
+                if limit and len(result) == limit:
+                    break
+        return result
+
+    def save(self, path):
+        '''Writes the index next to the database so the next start only has
+        to map it and catch up with the newer posts.'''
+        mask = _toInt(sorted(self.deleted)) if self.deleted else 0
+        directory = array('I')
+        # every writer gets its own file, the last one to finish replaces
+        # the index
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                        dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(bytes(self.HEADER.size))
+                posts = self.posts
+                if self.deleted:
+                    posts = array('I', (x for x in posts if x not in self.deleted))
+                for column in (self.post_ids, self.image_ids, self.board_ids, posts):
+                    f.write(bytes(column))
+                offset = f.tell()
+                for tag_id, postings in self.postings.items():
+                    if isinstance(postings, Bitmap):
+                        kind = self.DENSE
+                        if mask:
+                            postings = Bitmap.fromInt(postings.toInt() & ~mask)
+                        data = bytes(postings.data)
+                        # keep the offsets aligned to the array items
+                        data += bytes(-len(data) % 4)
+                    else:
+                        kind = self.SPARSE
+                        if mask:
+                            postings = array('I', (x for x in postings if x not in self.deleted))
+                        data = bytes(postings)
+                    if not len(postings):
+                        continue
+                    f.write(data)
+                    directory.extend((tag_id, kind, len(postings), (offset - self.HEADER.size) >> 2, len(data) >> 2))
+                    offset += len(data)
+                f.write(bytes(directory))
+                counters = self.counters or {}
+                f.seek(0)
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION, counters.get('posts', 0),
+                                         counters.get('purges', 0), self.max_post_id,
+                                         len(self.post_ids), len(posts), len(directory) // 5, offset))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.unsaved = 0
+
+    def load(self, path):
+        '''Maps the index file written by save, returns False if it is
+        missing or can't be read.'''
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return False
+
+        try:
+            (magic, version, posts_counter, purges_counter, max_post_id, columns,
+             posts, tags, offset) = self.HEADER.unpack_from(mapped)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError('unknown format')
+            if offset + tags * 20 != len(mapped):
+                raise ValueError('truncated file')
+            view = memoryview(mapped)[self.HEADER.size:offset].cast('I')
+            directory = memoryview(mapped)[offset:].cast('I')
+        except (struct.error, ValueError, TypeError) as e:
+            logging.debug("Ignoring the index file %s: %s", path, e)
+            mapped.close()
+            return False
+
+        self.clear()
+        self._mmap = mapped
+        self.post_ids = view[0:columns]
+        self.image_ids = view[columns:columns * 2]
+        self.board_ids = view[columns * 2:columns * 3]
+        self.posts = view[columns * 3:columns * 3 + posts]
+        for i in range(0, len(directory), 5):
+            tag_id, kind, count, start, length = directory[i:i + 5]
+            data = view[start:start + length]
+            if kind == self.DENSE:
+                self.postings[tag_id] = Bitmap(data.cast('B'), count)
+            else:
+                self.postings[tag_id] = data
+        self.max_post_id = max_post_id
+        self.counters = {'posts': posts_counter, 'purges': purges_counter}
+        return True
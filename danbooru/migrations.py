@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+
+
+def _add_columns(table, columns):
+    # sqlite has no "ADD COLUMN IF NOT EXISTS" and new databases already
+    # have the columns of the models
+    def add_columns(connection):
+        existing = set(row[1] for row in connection.execute("pragma table_info(%s)" % table))
+        for name, definition in columns:
+            if name not in existing:
+                connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, definition))
+    return add_columns
+
+
+# Schema changes applied on top of the tables created from the models. The
+# database version is kept in "pragma user_version" and every migration
+# newer than it is run in order, so new databases get all of them. The
+# statements (SQL or functions called with the connection) must be safe to
+# run again on a database that already has the change.
+MIGRATIONS = [
+    (1, [
+         # reverse lookup of the tags of a post, the primary key only
+         # covers (tag_id, post_id)
+         "CREATE INDEX IF NOT EXISTS ix_tag_post_post_id_tag_id ON tag_post (post_id, tag_id)",
+         "CREATE INDEX IF NOT EXISTS ix_pool_post_post_id_pool_id ON pool_post (post_id, pool_id)",
+         # board listings ordered by the remote id
+         "CREATE INDEX IF NOT EXISTS ix_post_board_id_post_id ON post (board_id, post_id DESC)",
+         # grouping by image and looking for images without posts
+         "CREATE INDEX IF NOT EXISTS ix_post_image_id ON post (image_id)",
+         # modified pools ordered by update time
+         "CREATE INDEX IF NOT EXISTS ix_pool_modified_updated_at ON pool (modified, updated_at)",
+         # width:/height: searches
+         "CREATE INDEX IF NOT EXISTS ix_image_width_height ON image (width, height)",
+         "CREATE INDEX IF NOT EXISTS ix_image_height ON image (height)",
+        ]),
+    (2, [
+         _add_columns('image', [('download_state', 'INTEGER NOT NULL DEFAULT 0'),
+                                ('download_size', 'INTEGER'),
+                                ('download_mtime', 'FLOAT')]),
+         # images that still have to be downloaded or checked
+         "CREATE INDEX IF NOT EXISTS ix_image_download_state ON image (download_state)",
+        ]),
+]
+
+
+def schema_version(connection):
+    return connection.execute("pragma user_version").scalar()
+
+
+def migrate(engine):
+    '''Brings the database schema up to date, returns the final version.'''
+    connection = engine.connect()
+    try:
+        version = schema_version(connection)
+        for number, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            logging.debug("Migrating database to version %i", number)
+            transaction = connection.begin()
+            for statement in statements:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.execute(statement)
+            connection.execute("pragma user_version=%i" % number)
+            transaction.commit()
+            version = number
+        return version
+    finally:
+        connection.close()
@@ -14,7 +14,9 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from sqlalchemy import Column, String, Integer
+from collections import namedtuple
+
+from sqlalchemy import Column, String, Integer, Float
 from sqlalchemy.orm import relationship, relation
 from sqlalchemy.schema import UniqueConstraint, ForeignKey, Table
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
@@ -39,11 +41,20 @@ class Board(Model, Base):
 
 
 class Image(Model, Base):
+    # download states, a downloaded file only had its size checked
+    PENDING = 0
+    DOWNLOADED = 1
+    VERIFIED = 2
+
     width = Column(Integer)
     height = Column(Integer)
     md5 = Column(String(32), unique=True, index=True)
     file_ext = Column(String(4))
     file_size = Column(Integer)
+    download_state = Column(Integer, nullable=False, default=PENDING, server_default='0')
+    # size and modification time of the file when its state was set
+    download_size = Column(Integer)
+    download_mtime = Column(Float)
 
 
 association_table__tag_post = Table('tag_post', Base.metadata,
@@ -115,3 +126,16 @@ class Pool(Model, Base):
     posts = relation('Post', secondary=association_table__pool_post)
 
     __table_args__ = (UniqueConstraint('pool_id', 'board_id'),)
+
+
+class Counter(Model, Base):
+    # bumped on every change of the posts so other processes can tell if
+    # the data they derived from the database is outdated
+    name = Column(String, nullable=False, unique=True)
+    value = Column(Integer, nullable=False, default=0)
+
+
+# plain rows of the read paths that only need a few columns, they use less
+# memory than the mapped objects and don't load anything on access
+PostRow = namedtuple('PostRow', 'id post_id board_id image_id file_url md5 file_ext file_size')
+PostDetails = namedtuple('PostDetails', 'id post_id rating score width height host tags pools')
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+from threading import Lock
+from time import monotonic, sleep, time
+from email.utils import parsedate_tz, mktime_tz
+
+from danbooru.error import DanbooruError
+
+
+class TokenBucket(object):
+    '''Allows bursts of `burst` requests and `rate` requests per second'''
+
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 300
+
+    def __init__(self, rate, burst=1):
+        if not rate or rate <= 0:
+            raise DanbooruError('Invalid request rate: %s' % rate)
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._last = monotonic()
+        self._blocked_until = 0
+        self._backoff = 0
+        self._lock = Lock()
+
+    def acquire(self):
+        '''Waits until a request can be sent.'''
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+    def backoff(self, retry_after=None):
+        '''Pauses the requests after the server asked to slow down, doubling
+        the pause on every consecutive call unless the server told how long
+        to wait. Returns the pause in seconds.'''
+        with self._lock:
+            if retry_after is None:
+                self._backoff = min(max(self._backoff * 2, self.MIN_BACKOFF), self.MAX_BACKOFF)
+                delay = self._backoff
+            else:
+                delay = min(retry_after, self.MAX_BACKOFF)
+            self._blocked_until = max(self._blocked_until, monotonic() + delay)
+            self._tokens = 0
+            return delay
+
+    def success(self):
+        with self._lock:
+            self._backoff = 0
+
+
+def retry_after(headers):
+    '''Returns the seconds indicated by a Retry-After header, if any.'''
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        date = parsedate_tz(value)
+        if date:
+            return max(mktime_tz(date) - time(), 0)
+
+
+_buckets = {}
+# the (rate, burst) asked for every host, to warn once about each conflict
+_limits = {}
+_buckets_lock = Lock()
+
+
+def get_bucket(host, rate, burst=1):
+    '''Returns the bucket shared by every client of the host. When the
+    clients ask for different limits the strictest ones are used.'''
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if not bucket:
+            bucket = _buckets[host] = TokenBucket(rate, burst)
+            _limits[host] = set([(rate, burst)])
+        elif (rate, burst) not in _limits[host]:
+            if not rate or rate <= 0:
+                raise DanbooruError('Invalid request rate: %s' % rate)
+            _limits[host].add((rate, burst))
+            with bucket._lock:
+                bucket.rate = min(bucket.rate, rate)
+                bucket.burst = min(bucket.burst, max(burst, 1))
+                bucket._tokens = min(bucket._tokens, bucket.burst)
+            logging.warning("Conflicting request limits for %s, using %g per second and bursts of %i",
+                            host, bucket.rate, bucket.burst)
+        return bucket
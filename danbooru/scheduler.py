@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from inspect import isgenerator
+from concurrent.futures import ThreadPoolExecutor
+
+from danbooru.database import Database
+
+
+class WriteQueue(object):
+    '''Runs the queued calls one at a time on a single thread'''
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def call(self, func, *args, **kwargs):
+        return self._executor.submit(func, *args, **kwargs).result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class QueuedDatabase(object):
+    '''Database whose method calls are serialized through a WriteQueue'''
+
+    def __init__(self, queue, *args, **kwargs):
+        self._queue = queue
+        # the sessions of the database are bound to the queue thread
+        self._db = queue.call(Database, *args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = self._queue.call(attr, *args, **kwargs)
+            if isgenerator(result):
+                return self._iterate(result)
+            return result
+        return call
+
+    def _iterate(self, generator):
+        # every step of the generator runs on the queue thread too
+        done = object()
+        try:
+            while True:
+                item = self._queue.call(next, generator, done)
+                if item is done:
+                    break
+                yield item
+        finally:
+            self._queue.call(generator.close)
+
+    def close(self):
+        self._queue.call(self._db.DBsession.remove)
@@ -32,6 +32,8 @@ class Settings(object):
                 setattr(self, key[0], self.config.getint(section, key[0]))
             elif key[1] == bool:
                 setattr(self, key[0], self.config.getboolean(section, key[0]))
+            elif key[1] == float:
+                setattr(self, key[0], self.config.getfloat(section, key[0]))
             else:
                 logging.warn("Unknown type: %s", key[1])
                 setattr(self, key[0], self.config.get(section, key[0]))
@@ -53,7 +55,8 @@ class Settings(object):
                     try:
                         self.set_value(key, "default")
                     except configparser.NoOptionError:
-                        setattr(self, key, optional[key])
+                        name = key[0] if isinstance(key, tuple) else key
+                        setattr(self, name, optional[key])
 
         except configparser.NoSectionError:
             logging.error('The section "%s" does not exist', section)
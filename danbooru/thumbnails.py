@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import sqlite3
+import logging
+import threading
+
+from os import makedirs
+from os.path import basename, splitext, exists, dirname, expanduser
+from concurrent.futures import ThreadPoolExecutor
+from PyQt4 import QtCore, QtGui
+
+from danbooru.utils import chunked
+
+
+DEFAULT_PATH = expanduser("~/.cache/danbooru-daemon/thumbnails.sqlite")
+
+
+class ThumbnailStore(object):
+    '''Keeps the thumbnails as JPEG blobs in a sqlite database keyed by the
+    md5 of the image, the least recently used ones are removed when the
+    store grows past max_size bytes.'''
+
+    THUMB_SIZE = 256
+    QUALITY = 85
+    MAX_SIZE = 512 * 1024 * 1024
+    # the store shrinks to this fraction of max_size when it is full
+    EVICT_RATIO = 0.9
+    # seconds before the last use of a thumbnail is updated again
+    TOUCH_INTERVAL = 3600
+    QUERY_CHUNK = 500
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path or DEFAULT_PATH
+        self.max_size = max_size or self.MAX_SIZE
+        makedirs(dirname(self.path), exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        connection = self._connection()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS thumbnail ("
+                               "md5 TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                               "size INTEGER NOT NULL, used REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_thumbnail_used ON thumbnail (used)")
+        self.total = self._totalSize(connection)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("pragma journal_mode=WAL")
+            connection.execute("pragma synchronous=NORMAL")
+            # the blobs are read from the mapped file without extra copies
+            connection.execute("pragma mmap_size=%i" % self.max_size)
+            self._local.connection = connection
+        return connection
+
+    def _totalSize(self, connection):
+        return connection.execute("SELECT COALESCE(SUM(size), 0) FROM thumbnail").fetchone()[0]
+
+    def full(self):
+        return self.total >= self.max_size * self.EVICT_RATIO
+
+    def get(self, md5):
+        '''Returns the JPEG data of the thumbnail, None if it isn't stored.'''
+        connection = self._connection()
+        row = connection.execute("SELECT data, used FROM thumbnail WHERE md5 = ?", (md5,)).fetchone()
+        if not row:
+            return None
+        now = time.time()
+        if row[1] < now - self.TOUCH_INTERVAL:
+            with connection:
+                connection.execute("UPDATE thumbnail SET used = ? WHERE md5 = ?", (now, md5))
+        return row[0]
+
+    def put(self, md5, data):
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO thumbnail (md5, data, size, used) VALUES (?, ?, ?, ?)",
+                               (md5, sqlite3.Binary(data), len(data), time.time()))
+        with self._lock:
+            self.total += len(data)
+            if self.total > self.max_size:
+                self._evict(connection)
+
+    def _evict(self, connection):
+        # other processes may share the store, start from the real size
+        self.total = self._totalSize(connection)
+        target = self.max_size * self.EVICT_RATIO
+        while self.total > target:
+            rows = connection.execute("SELECT md5, size FROM thumbnail ORDER BY used LIMIT ?",
+                                      (self.QUERY_CHUNK,)).fetchall()
+            if not rows:
+                break
+            removed = []
+            for md5, size in rows:
+                removed.append((md5,))
+                self.total -= size
+                if self.total <= target:
+                    break
+            with connection:
+                connection.executemany("DELETE FROM thumbnail WHERE md5 = ?", removed)
+        logging.debug("Thumbnail store reduced to %i bytes", self.total)
+
+    def missing(self, md5s):
+        '''Returns the set of md5s without a stored thumbnail.'''
+        connection = self._connection()
+        result = set(md5s)
+        for chunk in chunked(list(result), self.QUERY_CHUNK):
+            query = "SELECT md5 FROM thumbnail WHERE md5 IN (%s)" % ", ".join("?" * len(chunk))
+            result.difference_update(row[0] for row in connection.execute(query, chunk))
+        return result
+
+    def getThumbnail(self, path):
+        '''Returns the thumbnail of the image as a QImage, making and storing
+        it if needed.'''
+        md5 = splitext(basename(path))[0]
+        data = self.get(md5)
+        if data is not None:
+            image = QtGui.QImage()
+            if image.loadFromData(data, "JPG"):
+                return image
+        if exists(path):
+            image = self.scaleImage(path, self.THUMB_SIZE)
+            if not image.isNull():
+                self.put(md5, self.encode(image))
+            return image
+        else:
+            #TODO: get preview image from the Internet
+            pass
+
+    def makeThumbnail(self, path):
+        '''Stores the thumbnail of the image, returns True if it was made.'''
+        if not exists(path):
+            return False
+        image = self.scaleImage(path, self.THUMB_SIZE)
+        if image.isNull():
+            return False
+        self.put(splitext(basename(path))[0], self.encode(image))
+        return True
+
+    def prebuild(self, paths, workers=1):
+        '''Makes the thumbnails missing from the store without evicting the
+        stored ones, returns how many were made.'''
+        paths = dict((splitext(basename(path))[0], path) for path in paths)
+        missing = [paths[md5] for md5 in self.missing(paths)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return sum(1 for done in executor.map(self._prebuildOne, missing) if done)
+
+    def _prebuildOne(self, path):
+        if self.full():
+            return False
+        return self.makeThumbnail(path)
+
+    def encode(self, image):
+        buffer = QtCore.QBuffer()
+        buffer.open(QtCore.QIODevice.WriteOnly)
+        # JPEG has no alpha channel, keep the transparent areas white
+        if image.hasAlphaChannel():
+            background = QtGui.QImage(image.size(), QtGui.QImage.Format_RGB32)
+            background.fill(QtGui.QColor(QtCore.Qt.white).rgb())
+            painter = QtGui.QPainter(background)
+            painter.drawImage(0, 0, image)
+            painter.end()
+            image = background
+        image.save(buffer, "JPG", self.QUALITY)
+        return bytes(buffer.data())
+
+    def scaleImage(self, path, length):
+        image_reader = QtGui.QImageReader(path)
+        image_width = image_reader.size().width()
+        image_height = image_reader.size().height()
+        if image_width > image_height:
+            image_height = int(length * 1.0 / image_width * image_height)
+            image_width = length
+        elif image_width < image_height:
+            image_width = int(length * 1.0 / image_height * image_width)
+            image_height = length
+        else:
+            image_width = length
+            image_height = length
+        image_reader.setScaledSize(QtCore.QSize(image_width, image_height))
+        return QtGui.QImage(image_reader.read())
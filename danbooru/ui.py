@@ -14,101 +14,210 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import time
-from os import makedirs
+import logging
+from queue import Queue
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from PyQt4 import QtCore, QtGui
-from os.path import basename, splitext, exists, join, expanduser
 
-from danbooru.models import Post
+from danbooru.cache import LRUCache
+from danbooru.thumbnails import ThumbnailStore
+from danbooru.utils import image_path
 
 
-class ThumbnailCache(object):
+class SearchWorker(QtCore.QThread):
+    '''Searches the ids of the posts in the background, the posts are
+    loaded by the model as they are shown. Only the last of the waiting
+    searches is run, the results carry the number given to their search so
+    the ones of a replaced search can be ignored.'''
 
-    MAX_SIZE = 256
+    resultsSignal = QtCore.pyqtSignal(int, object)
 
-    def __init__(self, path):
-        self.path = path
-        makedirs(path, exist_ok=True)
-
-    def getThumbnail(self, path):
-        if exists(path):
-            base = splitext(basename(path))[0]
-            image = QtGui.QImage()
-            if image.load(join(self.path, base + ".png"), format="png"):
-                return image
-            else:
-                image = self.scaleImage(path, self.MAX_SIZE)
-                image.save(join(self.path, base + ".png"), format="png")
-                return image
-        else:
-            #TODO: get preview image from the Internet
-            pass
-
-    def scaleImage(self, path, length):
-        image_reader = QtGui.QImageReader(path)
-        image_width = image_reader.size().width()
-        image_height = image_reader.size().height()
-        if image_width > image_height:
-            image_height = int(length * 1.0 / image_width * image_height)
-            image_width = length
-        elif image_width < image_height:
-            image_width = int(length * 1.0 / image_height * image_width)
-            image_height = length
-        else:
-            image_width = length
-            image_height = length
-        image_reader.setScaledSize(QtCore.QSize(image_width, image_height))
-        return QtGui.QImage(image_reader.read())
-
-
-class ThumbnailWorker(QtCore.QThread):
-
-    makeIconSignal = QtCore.pyqtSignal(Post, object)
-    setStatusSignal = QtCore.pyqtSignal()
-    clearWidgetListSignal = QtCore.pyqtSignal()
-    abort = False
-
-    def __init__(self, ListWidget, basedir, parent=None):
+    def __init__(self, parent=None):
         QtCore.QThread.__init__(self, parent)
-        self.widget = ListWidget
-        self.basedir = basedir
-        user_path = expanduser("~")
-        self.thumbnail_dir = join(user_path, ".cache/danbooru-daemon/thumbnails")
-        makedirs(self.thumbnail_dir, exist_ok=True)
+        self.requests = Queue()
 
-    def setData(self, query, db):
-        self.query = query
-        self.db = db
+    def search(self, generation, query, db, post_filter=None):
+        self.requests.put((generation, query, db, post_filter))
 
     def stop(self):
-        self.abort = True
+        self.requests.put(None)
 
     def run(self):
-        self.abort = False
-        th = ThumbnailCache(self.thumbnail_dir)
-
-        self.clearWidgetListSignal.emit()
-
-        if self.query.get('site'):
-            self.db.setHost(host=None, alias=self.query['site'])
+        while True:
+            request = self.requests.get()
+            # skip the searches replaced by a newer one
+            while request and not self.requests.empty():
+                request = self.requests.get()
+            if request is None:
+                break
+            try:
+                ids = self._search(*request[1:])
+            except Exception:
+                # the thread has to keep serving the next searches
+                logging.exception("Search failed")
+                ids = []
+            self.resultsSignal.emit(request[0], ids)
+
+    def _search(self, query, db, post_filter):
+        if query.get('site'):
+            db.setHost(host=None, alias=query['site'])
         else:
-            self.db.clearHost()
-        if self.query.get('tags'):
-            posts = self.db.getANDPosts(self.query['tags'], limit=200, extra_items=self.query)
-        else:
-            posts = self.db.getPosts(200, extra_items=self.query)
+            db.clearHost()
+        blacklist = whitelist = None
+        if post_filter:
+            blacklist = post_filter.blacklist
+            whitelist = post_filter.whitelist
+        return db.getPostIds(query.get('tags'), query, blacklist, whitelist)
+
+
+class ThumbnailLoader(QtCore.QObject):
+    '''Makes the thumbnails of the requested rows on a pool of threads.
+    Only the last requested rows are made, the ones that were scrolled away
+    before their turn are skipped.'''
+
+    makeIconSignal = QtCore.pyqtSignal(int, int, object)
+
+    def __init__(self, store=None, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.store = store or ThumbnailStore()
+        self.workers = max(QtCore.QThread.idealThreadCount(), 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.generation = 0
+        self.wanted = set()
+        self.queued = set()
+        # the rows are requested from the UI thread and made on the pool
+        self._lock = Lock()
+
+    def reset(self):
+        '''Forgets the requests of the previous results.'''
+        with self._lock:
+            self.generation += 1
+            self.wanted = set()
+            self.queued = set()
+
+    def request(self, items):
+        '''Queues the (row, path) items, replacing the previous request.'''
+        with self._lock:
+            self.wanted = set(row for row, _ in items)
+            for row, path in items:
+                if row not in self.queued:
+                    self.queued.add(row)
+                    self.executor.submit(self._load, self.generation, row, path)
+
+    def _load(self, generation, row, path):
+        with self._lock:
+            if generation != self.generation:
+                return
+            if row not in self.wanted:
+                # requested again when it is visible
+                self.queued.discard(row)
+                return
+        image = self.store.getThumbnail(path)
+        self.makeIconSignal.emit(generation, row, image)
+        # the icon can be evicted from the model and requested again
+        with self._lock:
+            if generation == self.generation:
+                self.queued.discard(row)
+
+    def shutdown(self):
+        self.reset()
+        self.executor.shutdown()
+
+
+class PostListModel(QtCore.QAbstractListModel):
+    '''List of the found posts, only the ids are kept for every result and
+    the rows of the posts are loaded in batches as the view scrolls down.'''
+
+    FETCH_SIZE = 200
+    # icons kept in memory, the evicted ones are made again from the store
+    MAX_ICONS = 1024
 
-        if not posts:
-            self.setStatusSignal.emit()
-        else:
-            for post in posts:
-                if self.abort:
-                    time.sleep(1)
-                    break
-                img = post.image
-                full_path = join(self.basedir, img.md5[0], img.md5 + img.file_ext)
-                image = th.getThumbnail(full_path)
-                self.makeIconSignal.emit(post, image)
+    def __init__(self, parent=None):
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.db = None
+        self.ids = []
+        self.fetched = 0
+        self.posts = []
+        self.icons = LRUCache(self.MAX_ICONS)
+        self.default_icon = QtGui.QIcon().fromTheme("image-x-generic")
+
+    def setResults(self, ids):
+        self.beginResetModel()
+        self.ids = ids
+        self.fetched = 0
+        self.posts = []
+        self.icons.clear()
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.posts)
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and self.fetched < len(self.ids)
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return
+        ids = self.ids[self.fetched:self.fetched + self.FETCH_SIZE]
+        self.fetched += len(ids)
+        # the deleted posts are skipped
+        posts = self.db.getPostRows(ids)
+        if posts:
+            start = len(self.posts)
+            self.beginInsertRows(QtCore.QModelIndex(), start, start + len(posts) - 1)
+            self.posts.extend(posts)
+            self.endInsertRows()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        post = self.posts[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return post.md5 + post.file_ext
+        elif role == QtCore.Qt.DecorationRole:
+            return self.icons.get(index.row()) or self.default_icon
+        elif role == QtCore.Qt.TextAlignmentRole:
+            return int(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignBottom)
+        elif role == QtCore.Qt.UserRole:
+            return post
+        return None
+
+    def post(self, row):
+        return self.posts[row]
+
+    def hasIcon(self, row):
+        return self.icons.get(row) is not None
+
+    def setIcon(self, row, image):
+        if 0 <= row < len(self.posts):
+            pixmap = QtGui.QPixmap()
+            pixmap.convertFromImage(image)
+            self.icons.set(row, QtGui.QIcon(pixmap))
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def path(self, basedir, row):
+        post = self.posts[row]
+        return image_path(basedir, post.md5, post.file_ext)
+
+
+class ThumbnailDelegate(QtGui.QStyledItemDelegate):
+    '''Gives every item the size of the thumbnails plus room for the name.'''
+
+    MARGIN = 32
+
+    def __init__(self, size, parent=None):
+        QtGui.QStyledItemDelegate.__init__(self, parent)
+        self.size = size
+
+    def setSize(self, size):
+        self.size = size
+        # the view asks again for the size of the items
+        self.sizeHintChanged.emit(QtCore.QModelIndex())
+
+    def sizeHint(self, option, index):  # @UnusedVariable
+        return QtCore.QSize(self.size + self.MARGIN, self.size + self.MARGIN)
 
 
 class ImageView(QtGui.QGraphicsView):
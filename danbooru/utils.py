@@ -15,14 +15,12 @@
 #   limitations under the License.
 
 import re
+import json
+import codecs
+import operator
 from os.path import exists, join, dirname, abspath
 
 
-def list_generator(list_widget):
-    for i in range(list_widget.count()):
-        yield list_widget.item(i)
-
-
 def parse_dimension(term, dim):
     query = {}
     if term[len("%s:" % dim)] == ">":
@@ -71,6 +69,33 @@ def parse_query(text):
         return item
 
 
+def split_tags(tags):
+    '''Splits the search tags into the required ones, the groups where any
+    tag is enough ("~tag" or "tag1|tag2") and the excluded ones ("-tag").'''
+    include = []
+    exclude = []
+    any_tags = []
+    groups = []
+    for tag in tags:
+        if len(tag) > 1 and tag.startswith('-'):
+            exclude.append(tag[1:])
+        elif len(tag) > 1 and tag.startswith('~'):
+            any_tags.append(tag[1:])
+        elif '|' in tag.strip('|'):
+            groups.append([x for x in tag.split('|') if x])
+        else:
+            include.append(tag)
+    if any_tags:
+        groups.append(any_tags)
+    return include, groups, exclude
+
+
+def image_path(base, md5, file_ext):
+    '''Returns the path of a downloaded image, stored in a subdirectory
+    named after the first character of its md5.'''
+    return join(base, md5[0], md5 + file_ext)
+
+
 def find_resource(base, filename):
     base_path = [dirname(abspath(base)),
                  "/usr/local/share/danbooru-daemon",
@@ -85,39 +110,126 @@ def find_resource(base, filename):
     raise Exception("%s cannot be found." % filename)
 
 
-def filter_posts(posts, query):
-
-    if query.get('rating'):
-        posts[:] = [post for post in posts
-                    if post['rating'] == query['rating']]
-
-    if query.get('width'):
-        if query['width_type'] == "=":
-            posts[:] = [post for post in posts
-                        if post['width'] == query['width']]
-        if query['width_type'] == "<":
-            posts[:] = [post for post in posts
-                        if post['width'] < query['width']]
-        if query['width_type'] == ">":
-            posts[:] = [post for post in posts
-                        if post['width'] > query['width']]
-
-    if query.get('height'):
-        if query['height_type'] == "=":
-            posts[:] = [post for post in posts
-                        if post['height'] == query['height']]
-        if query['height_type'] == "<":
-            posts[:] = [post for post in posts
-                        if post['height'] < query['height']]
-        if query['height_type'] == ">":
-            posts[:] = [post for post in posts
-                        if post['height'] > query['height']]
-
-    if query.get('ratio'):
-        posts[:] = [post for post in posts
-                    if post['width'] * 1.0 / post['height'] ==
-                    query['ratio_width'] * 1.0 / query['ratio_height']]
-    return posts
+class PostFilter(object):
+    '''Decides which posts to keep, compiled once from a parsed query and
+    the blacklist and whitelist. The query terms become a tuple of checks
+    run in a single pass over every post.'''
+
+    COMPARISONS = {'=': operator.eq, '<': operator.lt, '>': operator.gt}
+
+    def __init__(self, query=None, blacklist=None, whitelist=None):
+        self.blacklist = frozenset(blacklist or ())
+        self.whitelist = frozenset(whitelist or ())
+        self.checks = self._compile(query or {})
+
+    def _compile(self, query):
+        checks = []
+        rating = query.get('rating')
+        if rating:
+            checks.append(lambda post: post['rating'] == rating)
+
+        for key in ('width', 'height'):
+            value = query.get(key)
+            compare = self.COMPARISONS.get(query.get(key + '_type'))
+            if value and compare:
+                checks.append(lambda post, key=key, compare=compare, value=value:
+                              compare(post[key], value))
+
+        if query.get('ratio'):
+            ratio = query['ratio_width'] * 1.0 / query['ratio_height']
+            checks.append(lambda post: post['width'] * 1.0 / post['height'] == ratio)
+        return tuple(checks)
+
+    @staticmethod
+    def splitTags(tags):
+        '''Returns the distinct tags of a space separated string.'''
+        return list(set(tags.split()))
+
+    def blacklisted(self, tags):
+        '''Tells if the tags (a list or set) have a blacklisted tag and no
+        whitelisted one.'''
+        return not self.blacklist.isdisjoint(tags) and self.whitelist.isdisjoint(tags)
+
+    def matchesQuery(self, post):
+        for check in self.checks:
+            if not check(post):
+                return False
+        return True
+
+    def __call__(self, post):
+        if self.blacklist and self.blacklisted(post['tags']):
+            return False
+        return self.matchesQuery(post)
+
+
+def chunked(iterable, size):
+    '''Yields lists of up to size items from iterable.'''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def grid_columns(width, item_width, spacing):
+    '''Returns the items per line of a wrapping icon view, every item
+    takes its width plus the spacing and the line starts after one more
+    spacing.'''
+    return max((width - spacing) // (item_width + spacing), 1)
+
+
+def visible_rows(count, columns, pitch, top, height):
+    '''Returns the range of the rows of a grid of count items that cross
+    the pixels top to top + height, measured from the first line of the
+    grid. Every line takes pitch pixels.'''
+    first = max(top, 0) // pitch
+    last = max(top + height - 1, 0) // pitch
+    return range(min(first * columns, count), min((last + 1) * columns, count))
+
+
+def iter_json_array(stream, chunk_size=16 * 1024):
+    '''Parses a JSON array from a binary stream, yielding every item as
+    soon as it has been read.'''
+    decoder = json.JSONDecoder()
+    reader = codecs.getincrementaldecoder('utf8')()
+    buf = ''
+    started = False
+    eof = False
+    while True:
+        buf = buf.lstrip()
+        if buf:
+            if not started:
+                if buf[0] != '[':
+                    raise ValueError("expected a JSON array")
+                started = True
+                buf = buf[1:]
+                continue
+            if buf[0] == ']':
+                return
+            if buf[0] == ',':
+                buf = buf[1:]
+                continue
+            try:
+                item, end = decoder.raw_decode(buf)
+            except ValueError:
+                # the item is incomplete, read more data unless there is none
+                if eof:
+                    raise
+            else:
+                # a number can go on in the next chunk ("1" of "12" or
+                # "1." of "1.5"), it is complete once a delimiter follows
+                if eof or not isinstance(item, (int, float)) or buf[end:end + 1] in (',', ']', ' ', '\t', '\r', '\n'):
+                    yield item
+                    buf = buf[end:]
+                    continue
+        if eof:
+            raise ValueError("truncated JSON array")
+        data = stream.read(chunk_size)
+        eof = not data
+        buf += reader.decode(data, final=eof)
 
 
 def remove_duplicates(posts):
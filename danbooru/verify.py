@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import hashlib
+import logging
+from time import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from danbooru.models import Image
+from danbooru.utils import image_path
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def file_hash(name, buffer_size=BUFFER_SIZE):
+    '''Returns the md5 hash object updated with the contents of the file,
+    raises IOError if it can't be read.'''
+    md5_hash = hashlib.md5()
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(name, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            md5_hash.update(view[:size])
+    return md5_hash
+
+
+def file_md5(name, buffer_size=BUFFER_SIZE):
+    '''Returns the md5 of the file or None if it can't be read.'''
+    try:
+        return file_hash(name, buffer_size).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+class Verifier(object):
+    '''Checks the downloaded files against the md5 of their images. The
+    files are hashed on a pool of threads since hashlib releases the GIL.
+    In trust mode the files whose size and mtime didn't change since their
+    state was saved aren't read.'''
+
+    _stop = False
+
+    def __init__(self, path, workers=4, trust=False):
+        self.path = path
+        self.workers = max(workers, 1)
+        self.trust = trust
+        self.files = 0
+        self.bytes = 0
+        self.trusted = 0
+        self.missing = 0
+        self.corrupt = 0
+        self.elapsed = 0
+        self._lock = Lock()
+
+    def stop(self):
+        logging.debug("Stopping verify job")
+        self._stop = True
+
+    def verifyImages(self, images):
+        '''Returns the (image id, state, size, mtime) of the images whose
+        download state changed.'''
+        start = time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            states = list(executor.map(self.verifyImage, images))
+        self.elapsed += time() - start
+        return [state for state in states if state]
+
+    def verifyImage(self, image):
+        if self._stop:
+            return None
+        filename = image_path(self.path, image.md5, image.file_ext)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            with self._lock:
+                self.missing += 1
+            if image.download_state == Image.PENDING:
+                return None
+            return (image.id, Image.PENDING, None, None)
+
+        if (self.trust and image.download_state != Image.PENDING and
+                st.st_size == image.download_size and st.st_mtime == image.download_mtime):
+            with self._lock:
+                self.trusted += 1
+            return None
+
+        # only the bytes actually hashed count for the throughput
+        read = 0
+        if image.file_size and st.st_size != image.file_size:
+            md5 = None
+        else:
+            md5 = file_md5(filename)
+            if md5:
+                read = st.st_size
+        with self._lock:
+            self.files += 1
+            self.bytes += read
+            if md5 != image.md5:
+                self.corrupt += 1
+
+        if md5 == image.md5:
+            state = Image.VERIFIED
+        else:
+            logging.warning("%s is corrupt, marking it for download", filename)
+            state = Image.PENDING
+        if (state == image.download_state and st.st_size == image.download_size and
+                st.st_mtime == image.download_mtime):
+            return None
+        return (image.id, state, st.st_size, st.st_mtime)
+
+    def throughput(self):
+        '''Returns the MB/s hashed so far.'''
+        if not self.elapsed:
+            return 0.0
+        return self.bytes / self.elapsed / (1024 * 1024)
@@ -22,23 +22,44 @@ import signal
 import shutil
 import logging
 import argparse
+import threading
+import os
 
-from os import listdir, makedirs
-from os.path import join, isdir, isfile, splitext, expanduser
+from queue import Queue, Full
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from os import makedirs
+from os.path import join, splitext, expanduser
 
 from danbooru.error import DanbooruError
 from danbooru.api import Api
 from danbooru.database import Database
 from danbooru.settings import Settings
 from danbooru.downloader import Downloader
-from danbooru.utils import parse_query
+from danbooru.verify import Verifier
+from danbooru.models import Image
+from danbooru.utils import parse_query, chunked, image_path, PostFilter
 from danbooru.gelbooru_api import GelbooruAPI
+from danbooru.scheduler import WriteQueue, QueuedDatabase
+from danbooru.connection import ConnectionPool
 
 
 class Daemon(object):
 
+    # posts saved per transaction while a page is parsed
+    INGEST_BATCH = 100
+    # parsed batches of a page waiting to be saved
+    INGEST_QUEUE = 4
+
+    # download subdirectories scanned at the same time by cleanup
+    SCAN_WORKERS = 16
+
     _stop = False
+    _stop_event = threading.Event()
     abort_list = {}
+    # newest image id walked by the thumbnails action for every store
+    _thumbnail_ids = {}
 
     config_required = [
                        'api_mode',
@@ -60,6 +81,26 @@ class Daemon(object):
                        'whitelist': None,
                        'dbname': None,
                         ('max_tags', int): 2,
+                        ('tag_cache_size', int): None,
+                        ('download_workers', int): 4,
+                        ('host_connections', int): 2,
+                        ('download_rate', float): 1.0,
+                        ('download_burst', int): 1,
+                        ('rate', float): None,
+                        ('burst', int): 1,
+                        ('http_timeout', int): 30,
+                        ('fetch_ahead', int): 2,
+                        ('verify_workers', int): 4,
+                        ('verify_trust', bool): False,
+                        'thumbnail_db': None,
+                        ('thumbnail_cache_size', int): None,
+                        ('prebuild_thumbnails', bool): False,
+                        'sqlite_busy_timeout': None,
+                        'sqlite_journal_mode': None,
+                        'sqlite_synchronous': None,
+                        'sqlite_cache_size': None,
+                        'sqlite_mmap_size': None,
+                        'sqlite_temp_store': None,
                     }
 
     def parseArgs(self):
@@ -78,20 +119,26 @@ class Daemon(object):
                 help='set the action to perform')
         parser.add_argument('-i', '--before-id', dest='before_id',
                 help='search using this id as starting point')
+        parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true',
+                help='only report what the cleanup action would do')
 
         return parser.parse_args()
 
     def readConfig(self, config, section, required_fields, optional_fields):
         cfg = Settings(config)
         if not cfg.load(section, required_fields, optional_fields):
-            sys.exit(1)
+            raise DanbooruError('Cannot load the config of %s' % section)
 
         if "log_level" in required_fields:
             numeric_level = getattr(logging, cfg.log_level.upper(), None)
             if not isinstance(numeric_level, int):
-                logging.error('Invalid log_level in config: %s' % cfg.log_level)
-                sys.exit(1)
+                raise DanbooruError('Invalid log_level in config: %s' % cfg.log_level)
             cfg.log_level = numeric_level
+
+        for name in ('rate', 'download_rate', 'host_connections'):
+            value = getattr(cfg, name, None)
+            if value is not None and value <= 0:
+                raise DanbooruError('Invalid %s in config: %s' % (name, value))
         return cfg
 
     def parseTags(self, args, cfg):
@@ -129,14 +176,16 @@ class Daemon(object):
 
     def abort(self):
         self._stop = True
-        for k in self.abort_list.keys():
-            self.abort_list[k].stop()
+        self._stop_event.set()
+        for job in list(self.abort_list.values()):
+            job.stop()
 
     def registerClassSignal(self, cls):
-        self.abort_list[cls.__class__.__name__] = cls
+        # keyed by instance since every daemon section runs its own jobs
+        self.abort_list[id(cls)] = cls
 
     def unregisterClassSignal(self, cls):
-        del self.abort_list[cls.__class__.__name__]
+        del self.abort_list[id(cls)]
 
     def signalHandler(self, signal, frame):  # @UnusedVariable
         logging.info('Ctrl+C detected, shutting down...')
@@ -145,18 +194,26 @@ class Daemon(object):
     def getLastId(self, tag, query, board, before_id=None):
         if before_id:
             return int(before_id)
-        else:
-            try:
-                posts = board.getPostsPage(tag, query, 1, 1)
-                if posts:
-                    return posts[0]['post_id'] + 1
-                else:
-                    logging.error('Error: cannot get last post id')
-            except DanbooruError as e:
-                logging.error(e.message)
-            sys.exit(1)
+        posts = list(board.getPostsPage(tag, query, 1, 1))
+        if not posts:
+            raise DanbooruError('Error: cannot get last post id')
+        return posts[0]['post_id'] + 1
+
+    def getBoard(self, cfg):
+        if cfg.api_mode == "gelbooru":
+            return GelbooruAPI(cfg.host, self.pool, cfg.rate, cfg.burst)
+        return Api(cfg.host, cfg.username, cfg.password, cfg.salt, self.pool, cfg.rate, cfg.burst)
 
     def main(self):
+        # the errors of a section thread only stop that section, the ones of
+        # the single actions end the process
+        try:
+            self.run_main()
+        except DanbooruError as e:
+            logging.error(e.message)
+            sys.exit(1)
+
+    def run_main(self):
         user_dir = expanduser("~")
         args = self.parseArgs()
 
@@ -170,6 +227,11 @@ class Daemon(object):
                             datefmt='%I:%M:%S %p')
 
         self.query = self.parseTags(args, cfg)
+        # the query terms and tag lists are checked on every fetched post
+        self.post_filter = PostFilter(self.query, args.blacklist, args.whitelist)
+
+        # keep-alive connections shared by every board and downloader
+        self.pool = ConnectionPool(cfg.http_timeout)
 
         signal.signal(signal.SIGINT, self.signalHandler)
 
@@ -178,36 +240,41 @@ class Daemon(object):
             makedirs(daemon_dir, exist_ok=True)
             cfg.dbname = join(daemon_dir, "danbooru-db.sqlite")
 
-        db = Database(cfg.dbname)
+        if args.action == "daemon":
+            # the sections open the database on their queue
+            self.run_daemon(args, cfg)
+            return
+
+        db = Database(cfg.dbname, cfg.tag_cache_size, Database.configPragmas(cfg))
         db.setHost(cfg.host, args.section)
 
-        if args.action == "daemon":
-            self.run_daemon(args, db)
-        elif args.action == "update":
-            if cfg.api_mode == "danbooru":
-                board = Api(cfg.host, cfg.username, cfg.password, cfg.salt)
-            elif cfg.api_mode == "gelbooru":
-                board = GelbooruAPI(cfg.host)
+        if args.action == "update":
+            board = self.getBoard(cfg)
             for tag in self.query['tags']:
                 logging.debug("processing tag [%s]" % tag)
                 self.run_update(args, tag, cfg, board, db)
         elif args.action == "download":
             self.run_download(cfg, db)
+        elif args.action == "verify":
+            self.run_verify(cfg, db)
+        elif args.action == "thumbnails":
+            self.startQt()
+            self.run_thumbnails(cfg, db)
         elif args.action == "nepomuk":
             self.run_nepomuk(cfg, db)
         elif args.action == "tags":
-            board = Api(cfg.host, cfg.username, cfg.password, cfg.salt)
+            board = self.getBoard(cfg)
             self.run_tags(args, db, board)
         elif args.action == "pools":
-            board = Api(cfg.host, cfg.username, cfg.password, cfg.salt)
+            board = self.getBoard(cfg)
             self.run_pools(db, board)
         elif args.action == "pool_posts":
-            board = Api(cfg.host, cfg.username, cfg.password, cfg.salt)
+            board = self.getBoard(cfg)
             self.run_pool_posts(db, board)
         elif args.action == "cleanup":
             self.cleanup(cfg, db, args, cfg.download_path)
 
-    def run_daemon(self, args, db):
+    def run_daemon(self, args, db_cfg):
         cfg = self.readConfig(args.config, "default", ['fetch_from', ('fetch_interval', int)], [])
 
         if not cfg.fetch_from:
@@ -218,101 +285,266 @@ class Daemon(object):
             logging.error('The fetch_interval config option cannot be empty in daemon mode')
             sys.exit(1)
 
-        sleep_time = cfg.fetch_interval
-        sections = [x.strip() for x in cfg.fetch_from.split(' ')]
-
+        sections = [x.strip() for x in cfg.fetch_from.split(' ') if x.strip()]
+        if any(self.prebuildsThumbnails(args, section) for section in sections):
+            self.startQt()
+
+        # every section runs on its own thread with its own interval, the
+        # database calls of all of them go through a single queue
+        queue = WriteQueue()
+        # the sections share the tag cache and index of this one
+        db = queue.call(Database, db_cfg.dbname, db_cfg.tag_cache_size, Database.configPragmas(db_cfg))
+        jobs = [threading.Thread(target=self.run_section, name=section,
+                                 args=(args, section, db, queue, cfg.fetch_interval))
+                for section in sections]
+        for job in jobs:
+            job.start()
+        # join with a timeout so the signal handler still gets to run
+        for job in jobs:
+            while job.is_alive():
+                job.join(1)
+        queue.call(db.DBsession.remove)
+        queue.shutdown()
+
+    def prebuildsThumbnails(self, args, section):
+        try:
+            cfg = self.readConfig(args.config, section, [], {('prebuild_thumbnails', bool): False})
+        except DanbooruError:
+            # the section reports it once it runs
+            return False
+        return cfg.prebuild_thumbnails
+
+    def run_section(self, args, section, shared, queue, fetch_interval):
+        optional = dict(self.config_optional)
+        optional[('fetch_interval', int)] = fetch_interval
+
+        db = QueuedDatabase(queue, shared=shared)
+        try:
+            self.run_section_loop(args, section, db, optional)
+        except DanbooruError as e:
+            logging.error("%s: %s, stopping the section", section, e.message)
+        except Exception:
+            logging.exception("%s: unexpected error, stopping the section", section)
+        finally:
+            db.close()
+
+    def run_section_loop(self, args, section, db, optional):
         while not self._stop:
-            for section in sections:
+            cfg = self.readConfig(args.config, section, self.config_required, optional)
+            db.setHost(cfg.host, section)
+            board = self.getBoard(cfg)
+            logging.debug(">>> Run update mode for %s", section)
+            for tag in self.query['tags']:
+                logging.debug("processing tag [%s]", tag)
+                self.run_update(args, tag, cfg, board, db)
                 if self._stop:
                     return
-                cfg = self.readConfig(args.config, section, self.config_required, self.config_optional)
-                db.setHost(cfg.host, section)
-                board = Api(cfg.host, cfg.username, cfg.password, cfg.salt)
-                logging.debug(">>> Run upload mode for %s", section)
-                for tag in self.query['tags']:
-                    logging.debug("processing tag [%s]", tag)
-                    self.run_update(args, tag, cfg, board, db)
-                    if self._stop:
-                        return
-                logging.debug(">>> Run download mode for %s", section)
-                self.run_download(cfg, db)
+            logging.debug(">>> Run download mode for %s", section)
+            self.run_download(cfg, db)
+            if self._stop:
+                return
+            if cfg.prebuild_thumbnails:
+                logging.debug(">>> Run thumbnails mode for %s", section)
+                self.run_thumbnails(cfg, db)
                 if self._stop:
                     return
-                #logging.debug("Run nepomuk mode for %s" % section)
-                #self.run_nepomuk(cfg, db)
-                #if self._abort: break
-            logging.debug("Waiting for %i seconds", sleep_time)
-            time.sleep(sleep_time)
+            #logging.debug("Run nepomuk mode for %s" % section)
+            #self.run_nepomuk(cfg, db)
+            #if self._abort: break
+            logging.debug("%s: waiting for %i seconds", section, cfg.fetch_interval)
+            self._stop_event.wait(cfg.fetch_interval)
 
     def run_update(self, args, tag, cfg, board, db):
         if not args.tags:
-            logging.error('No tags specified. Aborting.')
-            sys.exit(1)
+            raise DanbooruError('No tags specified. Aborting.')
 
         if cfg.fetch_mode == "id":
-            last_id = self.getLastId(tag, self.query, board, args.before_id)
-            logging.debug('Fetching posts below id: %i', last_id)
+            cursor = self.getLastId(tag, self.query, board, args.before_id)
         elif cfg.fetch_mode == "page":
-            page = 1
-            logging.debug('Fetching posts from page: %i', page)
+            cursor = 1
         else:
-            logging.error("Invalid fetch_mode")
-            sys.exit(1)
-
-        while not self._stop:
-            retries = 0
-            while retries < 3:
+            raise DanbooruError("Invalid fetch_mode: %s" % cfg.fetch_mode)
+
+        pages = self.fetchPages(args, tag, cfg, board, cursor)
+        try:
+            start = time.time()
+            for batches, page in pages:
+                results, count = self.savePage(db, batches)
+                last_post, fetch_time = page.result()
+                if not count:
+                    logging.debug('No posts returned')
+                    break
+                end = time.time()
+                logging.debug("New entries: %i posts, %i images, %i tags", results['posts'], results['images'], results['tags'])
+                logging.debug("Time taken: %.2f seconds (fetch and parse: %.2f)", end - start, fetch_time)
+                logging.debug("Tag cache: %(hits)i hits, %(misses)i misses, %(size)i/%(max_size)i entries", db.tag_cache.stats())
+                start = end
+                if not results['posts']:
+                    logging.debug('Stopping since no new posts were inserted')
+                    break
+        finally:
+            # cancels the pages still in flight
+            pages.close()
+
+    def fetchPage(self, args, tag, cfg, board, cursor, batches, cancel):
+        '''Puts the posts of the page on the batches queue in lists of
+        INGEST_BATCH as they are parsed, followed by None. Returns the last
+        post and the time taken.'''
+        retries = 0
+        last_post = None
+        start = time.time()
+        try:
+            while retries < 3 and not self._stop:
                 try:
                     if cfg.fetch_mode == "id":
-                        post_list = board.getPostsBefore(last_id, tag, self.query, cfg.limit, args.blacklist, args.whitelist)
+                        logging.debug('Fetching posts below id: %i', cursor)
+                        post_list = board.getPostsBefore(cursor, tag, self.post_filter, cfg.limit)
                     elif cfg.fetch_mode == "page":
-                        post_list = board.getPostsPage(tag, self.query, page, cfg.limit, args.blacklist, args.whitelist)
+                        logging.debug('Fetching posts from page: %i', cursor)
+                        post_list = board.getPostsPage(tag, self.post_filter, cursor, cfg.limit)
+                    for batch in chunked(post_list, self.INGEST_BATCH):
+                        if self._stop or not self._putBatch(batches, batch, cancel):
+                            break
+                        last_post = batch[-1]
                     break
                 except DanbooruError as e:
+                    # the posts saved before the error are skipped on retry
                     logging.error('>>> %s' % e.message)
                 retries += 1
                 logging.warning('Retrying (%i) in 2 seconds...', retries)
                 time.sleep(2)
-            else:
-                post_list = None
+        finally:
+            self._putBatch(batches, None, cancel)
+        return last_post, time.time() - start
 
-            if post_list:
-                start = time.time()
-                results = db.savePosts(post_list)
-                end = time.time() - start
-                logging.debug("New entries: %i posts, %i images, %i tags", results['posts'], results['images'], results['tags'])
-                logging.debug("Time taken: %.2f seconds" % end)
-                if not results['posts']:
-                    logging.debug('Stopping since no new posts were inserted')
-                    break
-                if cfg.fetch_mode == "id":
-                    last_id = post_list[-1]['post_id']
-                    logging.debug('Fetching posts below id: %i', last_id)
-                elif cfg.fetch_mode == "page":
-                    page += 1
-                    logging.debug('Fetching posts from page: %i', page)
-            else:
-                logging.debug('No posts returned')
+    def _putBatch(self, batches, batch, cancel):
+        # the queue is bounded, give up if nobody reads it anymore
+        while not cancel.is_set():
+            try:
+                batches.put(batch, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fetchPages(self, args, tag, cfg, board, cursor):
+        '''Yields the batches queue and the future of every page, the pages
+        are parsed in the background while their batches are saved. In page
+        mode up to fetch_ahead pages are requested at once. In id mode the
+        next page starts below the last post of the previous one, so it is
+        only requested after the caller has saved that page and resumes the
+        generator, and the pages are not pipelined.'''
+        if cfg.fetch_mode == "page":
+            ahead = max(cfg.fetch_ahead, 1)
+        else:
+            ahead = 1
+        executor = ThreadPoolExecutor(max_workers=ahead)
+        cancel = threading.Event()
+        pending = deque()
+
+        def submit(cursor):
+            batches = Queue(self.INGEST_QUEUE)
+            page = executor.submit(self.fetchPage, args, tag, cfg, board, cursor, batches, cancel)
+            pending.append((batches, page))
+
+        try:
+            for _ in range(ahead):
+                submit(cursor)
+                cursor += 1
+            while pending and not self._stop:
+                batches, page = pending.popleft()
+                if cfg.fetch_mode == "page":
+                    submit(cursor)
+                    cursor += 1
+                yield batches, page
+                last_post, _ = page.result()
+                if cfg.fetch_mode == "id" and last_post:
+                    submit(last_post['post_id'])
+        finally:
+            cancel.set()
+            for _, page in pending:
+                page.cancel()
+            executor.shutdown(wait=False)
+
+    def savePage(self, db, batches):
+        '''Saves the batches of a page as they arrive, returns the totals and
+        the number of posts read.'''
+        results = {'tags': 0, 'images': 0, 'posts': 0}
+        count = 0
+        while True:
+            batch = batches.get()
+            if batch is None:
                 break
+            count += len(batch)
+            for key, value in db.savePosts(batch).items():
+                results[key] += value
+        return results, count
 
     def run_download(self, cfg, db):
-        dl = Downloader(cfg.download_path)
+        dl = Downloader(cfg.download_path, cfg.download_workers,
+                        cfg.host_connections, cfg.download_rate,
+                        cfg.download_burst, self.pool)
         self.registerClassSignal(dl)
-        offset = 0
-        limit = 2048
 
         def callback(file, current, total):
             sys.stdout.write("\r%s: %i of %i bytes" % (file, current, total))
             sys.stdout.flush()
 
-        while not self._stop:
-            rows = db.getFiles(limit, offset)
-            if not rows:
+        # only the files that weren't downloaded or checked before
+        for rows in db.iterFiles(2048, cfg.skip_file_check):
+            if self._stop:
                 break
-            dl.downloadQueue(rows, cfg.skip_file_check, callback)
-            offset += limit
+            db.setDownloadStates(dl.downloadQueue(rows, cfg.skip_file_check, callback))
         self.unregisterClassSignal(dl)
 
+    def run_verify(self, cfg, db):
+        verifier = Verifier(cfg.download_path, cfg.verify_workers, cfg.verify_trust)
+        self.registerClassSignal(verifier)
+        for images in db.iterImages(1024):
+            if self._stop:
+                break
+            db.setDownloadStates(verifier.verifyImages(images))
+            logging.debug("Verified %i files, %.1f MB/s", verifier.files, verifier.throughput())
+        self.unregisterClassSignal(verifier)
+        logging.info("Verified %i files (%i MB) at %.1f MB/s: %i trusted, %i missing, %i corrupt",
+                     verifier.files, verifier.bytes // (1024 * 1024), verifier.throughput(),
+                     verifier.trusted, verifier.missing, verifier.corrupt)
+
+    def startQt(self):
+        '''Creates the application object needed to load the image format
+        plugins, it must be made on the main thread.'''
+        # PyQt4 is only needed to make thumbnails
+        from PyQt4 import QtCore
+        if not QtCore.QCoreApplication.instance():
+            self._app = QtCore.QCoreApplication([])
+
+    def run_thumbnails(self, cfg, db):
+        from PyQt4 import QtCore
+        from danbooru.thumbnails import ThumbnailStore
+        if not QtCore.QCoreApplication.instance():
+            logging.warning("Thumbnails can't be made without restarting the daemon")
+            return
+        size = cfg.thumbnail_cache_size * 1024 * 1024 if cfg.thumbnail_cache_size else None
+        store = ThumbnailStore(expanduser(cfg.thumbnail_db) if cfg.thumbnail_db else None, size)
+        workers = max(QtCore.QThread.idealThreadCount(), 1)
+        count = 0
+        # the images walked by a previous run aren't checked again, the
+        # ones downloaded late get their thumbnail from the viewer
+        after_id = self._thumbnail_ids.get(store.path)
+        last_id = after_id
+        # the newest images are the first ones shown by the viewer, the
+        # store isn't filled past its limit so they aren't evicted later
+        for images in db.iterImages(1024, newest=True, after_id=after_id):
+            if self._stop or store.full():
+                break
+            last_id = max(last_id or 0, images[0].id)
+            paths = [image_path(cfg.download_path, image.md5, image.file_ext)
+                     for image in images if image.download_state != Image.PENDING]
+            count += store.prebuild(paths, workers)
+        else:
+            self._thumbnail_ids[store.path] = last_id
+        logging.info("Made %i thumbnails, the store uses %i MB", count, store.total // (1024 * 1024))
+
     def run_nepomuk(self, cfg, db):
         from danbooru.nepomuk import NepomukTask
         nk = NepomukTask()
@@ -347,16 +579,12 @@ class Daemon(object):
                 break
 
     def run_pool_posts(self, db, board):
-        offset = 0
-        limit = 1000
         pools = list()
-        while not self._stop:
-            pools_data = db.getPools(limit, offset)
-            if not pools_data:
+        for pools_data in db.iterPools(1000):
+            if self._stop:
                 break
             pools += [x.pool_id for x in pools_data]
-            offset += limit
-            logging.debug('Building pool list: %i...', offset)
+            logging.debug('Building pool list: %i...', len(pools))
         logging.debug('Fetching posts from %i pools', len(pools))
         for pool in pools:
             page = 1
@@ -376,28 +604,60 @@ class Daemon(object):
                     logging.debug('Got %i/%i posts from pool %i', count, total, pool)
                     break
 
-    def clean_loop(self, directory, dest, db):
-        count = 0
-        for name in listdir(directory):
+    def clean_loop(self, directory):
+        '''Returns the (md5, path) of the files below the directory.'''
+        files = []
+        for entry in os.scandir(directory):
             if self._stop:
                 break
-            full_path = join(directory, name)
-            if isdir(full_path):
-                count += self.clean_loop(full_path, dest, db)
-            elif isfile(full_path):
-                md5 = splitext(name)[0]
-                if not db.fileExists(md5):
-                    logging.debug('%s isn\'t in database', name)
-                    shutil.move(full_path, join(dest, name))
-                    count += 1
-        return count
+            if entry.is_dir():
+                files += self.clean_loop(entry.path)
+            elif entry.is_file() and not entry.name.endswith('.part'):
+                # the .part files are downloads in progress
+                files.append((splitext(entry.name)[0], entry.path))
+        return files
 
     def cleanup(self, cfg, db, args, dest):
-        post_c, img_c, tag_c = db.deletePostsByTags(args.blacklist, args.whitelist)
-        logging.debug('Deleted %i posts, %i images refs, %i tags', post_c, img_c, tag_c)
-
-        count = self.clean_loop(cfg.download_path, dest, db)
-        logging.debug('Moved %i images', count)
+        if args.dry_run:
+            logging.info('Dry run, nothing will be deleted or moved')
+        else:
+            def callback(stage, current, total):
+                sys.stdout.write("\rPurging %s: %i of %i" % (stage, current, total))
+                sys.stdout.flush()
+
+            post_c, img_c, tag_c = db.deletePostsByTags(args.blacklist, args.whitelist, callback)
+            sys.stdout.write("\r")
+            logging.debug('Deleted %i posts, %i images refs, %i tags', post_c, img_c, tag_c)
+
+        start = time.time()
+        # the files in the destination are the ones already moved
+        directories = [entry.path for entry in os.scandir(cfg.download_path) if entry.is_dir()]
+        with ThreadPoolExecutor(max_workers=self.SCAN_WORKERS) as executor:
+            scans = executor.map(self.clean_loop, directories)
+            # loaded once while the directories are scanned
+            md5s = db.getMD5s()
+            files = [item for items in scans for item in items]
+        orphans = [path for md5, path in files if md5 not in md5s]
+        logging.info('Found %i of %i files not in the database in %.2f seconds',
+                     len(orphans), len(files), time.time() - start)
+        if args.dry_run or self._stop:
+            return
+
+        moved = 0
+        for path in orphans:
+            name = os.path.basename(path)
+            target = join(dest, name)
+            logging.debug('%s isn\'t in database', name)
+            try:
+                try:
+                    os.replace(path, target)
+                except OSError:
+                    # another filesystem
+                    shutil.move(path, target)
+                moved += 1
+            except (IOError, OSError) as e:
+                logging.error('Cannot move %s: %s', path, e)
+        logging.debug('Moved %i images', moved)
 
 if __name__ == '__main__':
     Daemon().main()
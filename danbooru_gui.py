@@ -26,6 +26,7 @@ from danbooru.settings import Settings
 from danbooru.database import Database
 from danbooru.error import DanbooruError
 from danbooru.ui import ImageViewer
+from danbooru.thumbnails import ThumbnailStore
 
 
 class DanbooruGUI(QtGui.QMainWindow):
@@ -52,20 +53,31 @@ class DanbooruGUI(QtGui.QMainWindow):
         return '<tr><td align="right"><b>%s:</b></td><td>%s</td></tr>' % (title, val)
 
     def setupThumbnailWorker(self):
-        self.thumb = ui.ThumbnailWorker(self.listWidget, self.BASE_DIR)
+        self.search = ui.SearchWorker(self)
+        self.search.resultsSignal.connect(self.setResults)
+        self.search_generation = 0
+        self.search.start()
+        store = ThumbnailStore(self.thumbnail_db, self.thumbnail_size)
+        self.thumb = ui.ThumbnailLoader(store, self)
         self.thumb.makeIconSignal.connect(self.makeIcon)
-        self.thumb.setStatusSignal.connect(self.setStatus)
-        self.thumb.clearWidgetListSignal.connect(self.clearWidgetList)
 
     def setupUI(self):
         # UI signals
         self.searchButton.clicked.connect(self.startSearch)
         self.queryBox.returnPressed.connect(self.startSearch)
         self.zoomSlider.sliderMoved.connect(self.sliderMove)
-        self.listWidget.itemEntered.connect(self.itemOver)
-        self.listWidget.itemSelectionChanged.connect(self.selectionChanged)
-        self.listWidget.itemDoubleClicked.connect(self.doubleClicked)
+        self.model = ui.PostListModel(self)
+        self.delegate = ui.ThumbnailDelegate(self.zoomSlider.value() * self.SLIDER_MULT, self)
+        self.listView.setModel(self.model)
+        self.listView.setItemDelegate(self.delegate)
+        self.listView.entered.connect(self.itemOver)
+        self.listView.selectionModel().selectionChanged.connect(self.selectionChanged)
+        self.listView.doubleClicked.connect(self.doubleClicked)
         self.infoLabel.linkActivated.connect(self.tagSelected)
+        # the thumbnails are made for the rows that become visible
+        self.listView.verticalScrollBar().valueChanged.connect(self.updateVisibleRows)
+        self.model.rowsInserted.connect(self.scheduleVisibleRows)
+        self.model.modelReset.connect(self.scheduleVisibleRows)
 
         # UI event overrides
         self.infoDock.resizeEvent = self.updatePreview
@@ -73,7 +85,8 @@ class DanbooruGUI(QtGui.QMainWindow):
         # UI settings
         pixels = self.zoomSlider.value() * self.SLIDER_MULT
         self.zoomSlider.setToolTip("Size: %i pixels" % pixels)
-        self.listWidget.setDragEnabled(False)
+        self.listView.setIconSize(QtCore.QSize(pixels, pixels))
+        self.listView.setDragEnabled(False)
 
         # Add clear button on queryBox
         self.clearButton = QtGui.QPushButton(self.queryBox)
@@ -96,17 +109,33 @@ class DanbooruGUI(QtGui.QMainWindow):
     def loadSettings(self):
         # load user settings
         user_dir = expanduser("~")
+        self.post_filter = utils.PostFilter()
+        self.thumbnail_db = None
+        self.thumbnail_size = None
         try:
             cfg = Settings(join(user_dir, ".danbooru-daemon.cfg"))
-            cfg.load("default", ['download_path'], {'dbname': None})
+            optional = {'dbname': None, 'blacklist': None, 'whitelist': None,
+                        'thumbnail_db': None, ('thumbnail_cache_size', int): None}
+            optional.update(('sqlite_' + name, None) for name, _ in Database.PRAGMAS)
+            cfg.load("default", ['download_path'], optional)
 
             # Get the base path for image search
             self.BASE_DIR = cfg.download_path
 
+            daemon_dir = join(user_dir, ".local/share/danbooru-daemon")
             if not cfg.dbname:
-                daemon_dir = join(user_dir, ".local/share/danbooru-daemon")
                 cfg.dbname = join(daemon_dir, "danbooru-db.sqlite")
-            self.db = Database(join(daemon_dir, cfg.dbname))
+            self.db = Database(join(daemon_dir, cfg.dbname), pragmas=Database.configPragmas(cfg))
+
+            # the daemon prebuilds the thumbnails in the same store
+            if cfg.thumbnail_db:
+                self.thumbnail_db = expanduser(cfg.thumbnail_db)
+            if cfg.thumbnail_cache_size:
+                self.thumbnail_size = cfg.thumbnail_cache_size * 1024 * 1024
+
+            # hide the blacklisted posts like the daemon skips them
+            split = utils.PostFilter.splitTags
+            self.post_filter = utils.PostFilter(None, split(cfg.blacklist or ''), split(cfg.whitelist or ''))
         except DanbooruError:
             self.statusLabel.setText(self.tr("No config loaded"))
             self.searchButton.setEnabled(False)
@@ -115,10 +144,13 @@ class DanbooruGUI(QtGui.QMainWindow):
     def toggleInfoPanel(self):
         self.infoDock.setVisible(not self.infoDock.isVisible())
 
-    def clearWidgetList(self):
-        self.listWidget.clear()
+    def closeEvent(self, event):
+        self.search.stop()
+        self.search.wait()
+        self.thumb.shutdown()
+        QtGui.QMainWindow.closeEvent(self, event)
 
-    def itemOver(self, item_img):
+    def itemOver(self, index):
         pass
 
     def updateClearButton(self, text):
@@ -141,23 +173,24 @@ class DanbooruGUI(QtGui.QMainWindow):
             else:
                 self.previewWidget.setPixmap(ui.getScaledPixmap(self.img, size))
 
-    def getItemPath(self, item):
-        post = item.data(QtCore.Qt.UserRole)
-        sess = self.db.DBsession()
-        post = sess.merge(post)
-        img = post.image
-        return join(self.BASE_DIR, img.md5[0], img.md5 + img.file_ext)
+    def getItemPath(self, index):
+        return self.model.path(self.BASE_DIR, index.row())
+
+    def moveCurrentRow(self, step):
+        row = self.listView.currentIndex().row() + step
+        if row >= self.model.rowCount() and self.model.canFetchMore():
+            self.model.fetchMore()
+        index = self.model.index(row)
+        if index.isValid():
+            self.listView.selectionModel().setCurrentIndex(index, QtGui.QItemSelectionModel.ClearAndSelect)
+        return self.listView.currentIndex()
 
     def nextImage(self, viewer):
-        self.listWidget.setCurrentRow(self.listWidget.currentRow() + 1, QtGui.QItemSelectionModel.SelectCurrent)
-        item = self.listWidget.currentItem()
-        path = self.getItemPath(item)
+        path = self.getItemPath(self.moveCurrentRow(1))
         viewer.loadImage(path=path)
 
     def prevImage(self, viewer):
-        self.listWidget.setCurrentRow(self.listWidget.currentRow() - 1, QtGui.QItemSelectionModel.SelectCurrent)
-        item = self.listWidget.currentItem()
-        path = self.getItemPath(item)
+        path = self.getItemPath(self.moveCurrentRow(-1))
         viewer.loadImage(path=path)
 
     def showImage(self, full_path):
@@ -169,52 +202,50 @@ class DanbooruGUI(QtGui.QMainWindow):
         viewer.exec()
         self.show()
 
-    def doubleClicked(self, item):
-        path = self.getItemPath(item)
+    def doubleClicked(self, index):
+        path = self.getItemPath(index)
         self.showImage(path)
 
     def buildInfoTag(self, post):
-        tags = ['<a href="%s">%s</a>' % (tag.name, tag.name) for tag in post.tags]
-        pools = ['<a href="pool:%i">%s</a>' % (pool.pool_id, pool.name) for pool in post.pools]
+        tags = ['<a href="%s">%s</a>' % (name, name) for name in post.tags]
+        pools = ['<a href="pool:%i">%s</a>' % (pool_id, name) for pool_id, name in post.pools]
 
         table_items = list()
-        table_items.append(self.table_entry(self.tr("Width"), post.image.width, "width:%i" % post.image.width))
-        table_items.append(self.table_entry(self.tr("Height"), post.image.height, "height:%i" % post.image.height))
+        table_items.append(self.table_entry(self.tr("Width"), post.width, "width:%i" % post.width))
+        table_items.append(self.table_entry(self.tr("Height"), post.height, "height:%i" % post.height))
         if tags:
             table_items.append(self.table_entry(self.tr("Tags"), " ".join(tags)))
         table_items.append(self.table_entry(self.tr("Rating"), self.RATING[post.rating], "rating:%s" % post.rating))
         table_items.append(self.table_entry(self.tr("Score"), post.score))
-        table_items.append(self.table_entry(self.tr("From"), post.board.host))
+        table_items.append(self.table_entry(self.tr("From"), post.host))
         table_items.append(self.table_entry(self.tr("ID"), post.post_id))
         if pools:
             table_items.append(self.table_entry(self.tr("Pools"), " ".join(pools)))
-        page_url = "%s/post/show/%i" % (post.board.host, post.post_id)
+        page_url = "%s/post/show/%i" % (post.host, post.post_id)
         table_items.append(self.table_entry(self.tr("URL"), page_url, page_url))
         return "<table>%s</table>" % "".join(table_items)
 
-    def selectionChanged(self):
-        items = self.listWidget.selectedItems()
-        if not items:
+    def selectionChanged(self, selected=None, deselected=None):  # @UnusedVariable
+        indexes = self.listView.selectionModel().selectedIndexes()
+        if not indexes:
             self.nameLabel.setText(self.tr("No selection"))
             self.img = None
-        elif len(items) == 1:
-            item = items[0]
-            self.listWidget.scrollToItem(item)
+        elif len(indexes) == 1:
+            index = indexes[0]
+            self.listView.scrollTo(index)
             self.nameLabel.setText(self.tr("1 selected item"))
-            post = item.data(QtCore.Qt.UserRole)
-            sess = self.db.DBsession()
-            post = sess.merge(post)
-            img = post.image
-            full_path = join(self.BASE_DIR, img.md5[0], img.md5 + img.file_ext)
-            self.img = QtGui.QImage(full_path)
+            post_id = self.model.post(index.row()).id
+            self.img = QtGui.QImage(self.getItemPath(index))
 
             if not self.img or self.img.byteCount() == 0:
                 self.img = QtGui.QIcon().fromTheme("image-x-generic")
 
             self.updatePreview()
-            self.infoLabel.setText(self.buildInfoTag(post))
+            details = self.db.getPostDetails([post_id]).get(post_id)
+            if details:
+                self.infoLabel.setText(self.buildInfoTag(details))
         else:
-            self.nameLabel.setText(self.tr("%i selected items") % len(items))
+            self.nameLabel.setText(self.tr("%i selected items") % len(indexes))
             self.img = None
 
     def tagSelected(self, tag):
@@ -224,38 +255,47 @@ class DanbooruGUI(QtGui.QMainWindow):
             self.queryBox.setText(self.queryBox.text() + " %s" % tag)
             self.startSearch()
 
-    def makeIcon(self, post, image):
-        item = self.addItem(post)
-        value = self.zoomSlider.value() * self.SLIDER_MULT
-        if image:
-            pixmap = QtGui.QPixmap(value, value)
-            pixmap.convertFromImage(image)
-            icon = QtGui.QIcon(pixmap)
-            item.setIcon(icon)
-        self.statusLabel.setText(self.tr("Found %i images") %
-                                 self.listWidget.count())
+    def makeIcon(self, generation, row, image):
+        # icons of a previous search are dropped
+        if generation == self.thumb.generation and image:
+            self.model.setIcon(row, image)
+
+    def scheduleVisibleRows(self):
+        # wait for the view to lay out the new rows
+        QtCore.QTimer.singleShot(0, self.updateVisibleRows)
 
-    def setStatus(self):
-        self.statusLabel.setText(self.tr("No results"))
+    def updateVisibleRows(self, value=None):  # @UnusedVariable
+        count = self.model.rowCount()
+        if not count:
+            return
+        # the corners of the viewport usually fall in the spacing between
+        # the items, the rows are taken from the layout of the grid instead
+        spacing = self.listView.spacing()
+        size = self.delegate.sizeHint(None, None)
+        viewport = self.listView.viewport().rect()
+        origin = self.listView.visualRect(self.model.index(0))
+        columns = utils.grid_columns(viewport.width(), size.width(), spacing)
+        rows = utils.visible_rows(count, columns, size.height() + spacing,
+                                  viewport.top() - origin.top(), viewport.height())
+        self.thumb.request([(row, self.model.path(self.BASE_DIR, row))
+                            for row in rows if not self.model.hasIcon(row)])
+
+    def setResults(self, generation, ids):
+        # a newer search was started while this one ran
+        if generation != self.search_generation:
+            return
+        self.model.setResults(ids)
+        if ids:
+            self.statusLabel.setText(self.tr("Found %i images") % len(ids))
+        else:
+            self.statusLabel.setText(self.tr("No results"))
 
     def sliderMove(self, value):
         value *= self.SLIDER_MULT
         self.zoomSlider.setToolTip(self.tr("Size: %i pixels") % value)
-        self.listWidget.setIconSize(QtCore.QSize(value, value))
-        generator = utils.list_generator(self.listWidget)
-        for item in generator:
-            item.setSizeHint(QtCore.QSize(value + 32, value + 32))
-
-    def addItem(self, post):
-        item = QtGui.QListWidgetItem()
-        item.setText(post.image.md5 + post.image.file_ext)
-        item.setIcon(QtGui.QIcon().fromTheme("image-x-generic"))
-        item.setData(QtCore.Qt.UserRole, post)
-        item.setTextAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignBottom)
-        value = self.zoomSlider.value() * self.SLIDER_MULT
-        item.setSizeHint(QtCore.QSize(value + 32, value + 32))
-        self.listWidget.addItem(item)
-        return item
+        self.listView.setIconSize(QtCore.QSize(value, value))
+        self.delegate.setSize(value)
+        self.scheduleVisibleRows()
 
     def startSearch(self):
         text = self.queryBox.text().strip()
@@ -272,15 +312,13 @@ class DanbooruGUI(QtGui.QMainWindow):
             self.statusLabel.setText(self.tr("Search by rating depends on site"))
             return
 
-        self.thumb.stop()
-        self.thumb.wait()
+        self.search_generation += 1
+        self.thumb.reset()
+        self.model.setResults([])
+        self.model.db = self.db
 
         self.statusLabel.setText(self.tr("Processing..."))
-        self.thumb.setData(query, self.db)
-
-        size = self.zoomSlider.value() * self.SLIDER_MULT
-        self.listWidget.setIconSize(QtCore.QSize(size, size))
-        self.thumb.start()
+        self.search.search(self.search_generation, query, self.db, self.post_filter)
 
 if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
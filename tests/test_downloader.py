@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from danbooru.downloader import Downloader
+from danbooru.models import Image, PostRow
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    '''Serves the files of the server slowly, counting the requests that are
+    answered at the same time.'''
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        data = server.files.get(self.path.lstrip('/'))
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.requests += 1
+        try:
+            time.sleep(server.delay)
+        finally:
+            with server.lock:
+                server.active -= 1
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloaderTest(unittest.TestCase):
+
+    DELAY = 0.2
+    FILES = 8
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = ThreadingServer(('127.0.0.1', 0), FileHandler)
+        self.server.lock = threading.Lock()
+        self.server.delay = self.DELAY
+        self.server.active = self.server.max_active = self.server.requests = 0
+        self.server.files = {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.host = "http://127.0.0.1:%i" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.path)
+
+    def makePosts(self, count, prefix):
+        posts = []
+        for i in range(count):
+            data = ("%s %i" % (prefix, i)).encode('ascii') * 100
+            md5 = hashlib.md5(data).hexdigest()
+            self.server.files[md5 + ".jpg"] = data
+            posts.append(PostRow(i + 1, i + 1, 1, i + 1, "%s/%s.jpg" % (self.host, md5),
+                                 md5, ".jpg", len(data)))
+        return posts
+
+    def download(self, posts, workers, connections=8):
+        downloader = Downloader(self.path, workers=workers, host_connections=connections,
+                                rate=1000, burst=1000)
+        return downloader.downloadQueue(posts)
+
+    def testWorkers(self):
+        # the files are got at the same time, up to the host limit
+        start = time.time()
+        states = self.download(self.makePosts(self.FILES, 'serial'), 1)
+        serial = time.time() - start
+        start = time.time()
+        states += self.download(self.makePosts(self.FILES, 'parallel'), 4)
+        parallel = time.time() - start
+
+        self.assertEqual(len(states), self.FILES * 2)
+        self.assertTrue(all(state[1] == Image.VERIFIED for state in states))
+        self.assertGreaterEqual(serial, self.FILES * self.DELAY)
+        self.assertLess(parallel, serial / 2)
+        self.assertEqual(self.server.max_active, 4)
+
+    def testHostConnections(self):
+        # the connection limit of the host covers every downloader
+        posts = self.makePosts(self.FILES, 'shared')
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(lambda part: self.download(part, 4, 2),
+                                        (posts[::2], posts[1::2])))
+        self.assertEqual(sum(len(states) for states in results), self.FILES)
+        self.assertEqual(self.server.requests, self.FILES)
+        self.assertEqual(self.server.max_active, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
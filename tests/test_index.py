@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from array import array
+
+from danbooru.database import Database
+from danbooru.index import Bitmap, TagIndex, difference, intersect, toIds, union
+
+TAGS = ['t%i' % i for i in range(12)]
+
+
+def kinds(ids):
+    '''The same ids as every kind of posting list.'''
+    bitmap = Bitmap.fromIds(ids)
+    return [array('I', ids), bitmap, bitmap.toInt()]
+
+
+def make_posts(first, count):
+    return [{'post_id': i, 'md5': '%032x' % i, 'file_url': 'http://test/%i.jpg' % i,
+             'tags': random.sample(TAGS, random.randint(1, 5)), 'width': 1000, 'height': 800,
+             'rating': 's', 'file_size': 1000, 'created_at': None} for i in range(first, first + count)]
+
+
+class PostingsTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(4)
+        # a dense, a sparse, an empty list and one that is much shorter
+        # than the others
+        self.sets = [set(random.sample(range(1, 2000), 900)), set(random.sample(range(1, 2000), 40)),
+                     set(), set(random.sample(range(1, 2000), 3))]
+
+    def pairs(self):
+        for a in self.sets:
+            for b in self.sets:
+                for x in kinds(sorted(a)):
+                    for y in kinds(sorted(b)):
+                        yield a, b, x, y
+
+    def testIntersect(self):
+        for a, b, x, y in self.pairs():
+            self.assertEqual(toIds(intersect(x, y)), sorted(a & b))
+
+    def testDifference(self):
+        for a, b, x, y in self.pairs():
+            self.assertEqual(toIds(difference(x, y)), sorted(a - b))
+
+    def testUnion(self):
+        for a, b, x, y in self.pairs():
+            self.assertEqual(toIds(union([x, y])), sorted(a | b))
+        self.assertEqual(toIds(union([])), [])
+
+    def testBitmap(self):
+        bitmap = Bitmap(bytes(Bitmap.fromIds([3, 9]).data), 2)
+        bitmap.add(9)
+        bitmap.add(70)
+        self.assertEqual((bitmap.ids(), len(bitmap)), ([3, 9, 70], 3))
+        self.assertTrue(70 in bitmap)
+        self.assertFalse(71 in bitmap)
+        self.assertFalse(1000 in bitmap)
+
+
+class TagIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        random.seed(5)
+        self.index = TagIndex()
+        self.tags = {}
+        for x in range(1, 501):
+            self.index.addPost(x, 1000 - x, x, 1 + x % 2)
+            for tag_id in random.sample(range(1, 9), 3):
+                self.index.addTag(tag_id, x)
+                self.tags.setdefault(tag_id, set()).add(x)
+        self.index.optimize()
+        self.index.counters = {'posts': 10, 'purges': 2}
+
+    def tearDown(self):
+        self.index.clear()
+        shutil.rmtree(self.path)
+
+    def searches(self):
+        return [([1], (), ()), ([1, 2], (), ()), ([3], [[4, 5]], [6]), ([], [[7, 99]], ()), ([99], (), ())]
+
+    def testRoundTrip(self):
+        self.index.removePosts([5, 6])
+        expected = [self.index.search(*x) for x in self.searches()]
+        path = os.path.join(self.path, 'index')
+        self.index.save(path)
+
+        loaded = TagIndex()
+        self.assertTrue(loaded.load(path))
+        self.assertEqual([loaded.search(*x) for x in self.searches()], expected)
+        self.assertEqual(loaded.counters, self.index.counters)
+        self.assertEqual(loaded.max_post_id, 500)
+        self.assertEqual(len(loaded), 498)
+        self.assertEqual(loaded.top(loaded.filterBoard(loaded.search([1]), 2), 3),
+                         self.index.top(self.index.filterBoard(expected[0], 2), 3))
+        # the loaded index can still be updated
+        loaded.addPost(501, 1, 501, 1)
+        loaded.addTag(1, 501)
+        self.assertEqual(loaded.search([1])[-1], 501)
+        loaded.clear()
+
+    def testBadFile(self):
+        path = os.path.join(self.path, 'index')
+        self.index.save(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        for broken in (data[:-4], data[:10], b'XIDX' + data[4:], b''):
+            with open(path, 'wb') as f:
+                f.write(broken)
+            self.assertFalse(TagIndex().load(path))
+        self.assertFalse(TagIndex().load(os.path.join(self.path, 'missing')))
+
+
+class IndexFileTest(unittest.TestCase):
+    '''Opens the database with an index file that is out of date or broken,
+    the searches must match the tags stored in the database.'''
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.path, 'test.sqlite')
+        random.seed(6)
+        db = self.open()
+        db.savePosts(make_posts(1, 200))
+        db.getPostIds(['t0'])
+        self.close(db)
+        self.assertTrue(os.path.exists(self.dbname + '.tagindex'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open(self):
+        db = Database(self.dbname)
+        db.setHost('http://test', 'test')
+        return db
+
+    def close(self, db):
+        db.tag_index.clear()
+        db.DBsession.remove()
+        db.engine.dispose()
+
+    def expected(self, tags):
+        connection = sqlite3.connect(self.dbname)
+        ids = None
+        for tag in tags:
+            q = connection.execute("SELECT post.id FROM post JOIN tag_post ON post.id = tag_post.post_id "
+                                   "JOIN tag ON tag.id = tag_post.tag_id WHERE tag.name = ?", (tag,))
+            found = set(x for x, in q)
+            ids = found if ids is None else ids & found
+        q = connection.execute("SELECT id, post_id FROM post")
+        post_ids = dict(q.fetchall())
+        connection.close()
+        return sorted(ids, key=post_ids.get, reverse=True)
+
+    def check(self):
+        db = self.open()
+        for tags in (['t0'], ['t1', 't2'], ['t3', 't4', 't5']):
+            self.assertEqual(db.getPostIds(tags), self.expected(tags))
+        self.close(db)
+
+    def changeWithOldFile(self, change):
+        # another process changes the database and the index file is
+        # restored to the version before the change
+        index_path = self.dbname + '.tagindex'
+        shutil.copy(index_path, index_path + '.old')
+        db = self.open()
+        change(db)
+        db.getPostIds(['t0'])
+        self.close(db)
+        os.replace(index_path + '.old', index_path)
+
+    def testNewPosts(self):
+        self.changeWithOldFile(lambda db: db.savePosts(make_posts(201, 50)))
+        self.check()
+
+    def testPurgedPosts(self):
+        self.changeWithOldFile(lambda db: db.deletePostsByTags(['t1'], ['t2']))
+        self.check()
+
+    def testTruncatedFile(self):
+        index_path = self.dbname + '.tagindex'
+        with open(index_path, 'r+b') as f:
+            f.truncate(os.path.getsize(index_path) // 2)
+        self.check()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from sqlalchemy.sql.expression import and_, or_
+
+from danbooru.database import Database
+from danbooru.migrations import MIGRATIONS, schema_version
+from danbooru.models import Image, Pool, Post, Tag, association_table__tag_post
+
+
+# the tables made by the models before the first migration
+BASELINE_SCHEMA = """
+CREATE TABLE board (
+    id INTEGER NOT NULL, host VARCHAR, alias VARCHAR,
+    PRIMARY KEY (id), UNIQUE (host, alias));
+CREATE INDEX ix_board_alias ON board (alias);
+CREATE TABLE image (
+    id INTEGER NOT NULL, width INTEGER, height INTEGER, md5 VARCHAR(32),
+    file_ext VARCHAR(4), file_size INTEGER,
+    PRIMARY KEY (id));
+CREATE UNIQUE INDEX ix_image_md5 ON image (md5);
+CREATE TABLE tag (
+    id INTEGER NOT NULL, name VARCHAR NOT NULL,
+    PRIMARY KEY (id));
+CREATE UNIQUE INDEX ix_tag_name ON tag (name);
+CREATE TABLE post (
+    id INTEGER NOT NULL, post_id INTEGER, file_url VARCHAR, author VARCHAR,
+    creator_id INTEGER, rating VARCHAR, source VARCHAR, score INTEGER,
+    parent_id INTEGER, status VARCHAR, change INTEGER, created_at VARCHAR,
+    sample_url VARCHAR, sample_width INTEGER, sample_height INTEGER,
+    preview_url VARCHAR, preview_width INTEGER, preview_height INTEGER,
+    has_notes INTEGER, has_comments INTEGER, has_children INTEGER,
+    board_id INTEGER, image_id INTEGER,
+    PRIMARY KEY (id), UNIQUE (post_id, board_id),
+    FOREIGN KEY(board_id) REFERENCES board (id) ON DELETE CASCADE,
+    FOREIGN KEY(image_id) REFERENCES image (id) ON DELETE CASCADE);
+CREATE INDEX ix_post_post_id ON post (post_id);
+CREATE TABLE pool (
+    id INTEGER NOT NULL, pool_id INTEGER, name INTEGER, created_at VARCHAR,
+    updated_at VARCHAR, post_count INTEGER, user_id INTEGER,
+    is_public BOOLEAN, modified BOOLEAN, board_id INTEGER,
+    PRIMARY KEY (id), UNIQUE (pool_id, board_id),
+    CHECK (is_public IN (0, 1)), CHECK (modified IN (0, 1)),
+    FOREIGN KEY(board_id) REFERENCES board (id) ON DELETE CASCADE);
+CREATE INDEX ix_pool_pool_id ON pool (pool_id);
+CREATE TABLE tag_post (
+    tag_id INTEGER NOT NULL, post_id INTEGER NOT NULL,
+    PRIMARY KEY (tag_id, post_id),
+    FOREIGN KEY(tag_id) REFERENCES tag (id) ON DELETE CASCADE,
+    FOREIGN KEY(post_id) REFERENCES post (id) ON DELETE CASCADE);
+CREATE TABLE pool_post (
+    pool_id INTEGER NOT NULL, post_id INTEGER NOT NULL,
+    PRIMARY KEY (pool_id, post_id),
+    FOREIGN KEY(pool_id) REFERENCES pool (id) ON DELETE CASCADE,
+    FOREIGN KEY(post_id) REFERENCES post (id) ON DELETE CASCADE);
+"""
+
+
+class QueryPlanTest(unittest.TestCase):
+    '''Checks that the hot queries are answered with the indexes added by the
+    migrations instead of scanning the tables.'''
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.path, 'test.sqlite')
+        self.db = Database(self.dbname)
+
+    def tearDown(self):
+        self.db.DBsession.remove()
+        self.db.engine.dispose()
+        shutil.rmtree(self.path)
+
+    def plan(self, query):
+        compiled = query.statement.compile(dialect=self.db.engine.dialect)
+        params = [compiled.params[name] for name in compiled.positiontup]
+        connection = self.db.engine.raw_connection()
+        try:
+            rows = connection.execute("EXPLAIN QUERY PLAN " + str(compiled), params).fetchall()
+        finally:
+            connection.close()
+        return [row[-1] for row in rows]
+
+    def assertUsesIndex(self, query, table, index):
+        plan = self.plan(query)
+        steps = [step for step in plan if re.match(r'(SEARCH|SCAN) (TABLE )?%s\b' % table, step)]
+        self.assertTrue(steps, plan)
+        for step in steps:
+            # a SCAN reads the whole table or index even when it names one
+            self.assertTrue(step.startswith('SEARCH'), plan)
+            self.assertIn('INDEX %s ' % index, step + ' ', plan)
+
+    def testVersion(self):
+        connection = self.db.engine.connect()
+        try:
+            self.assertEqual(schema_version(connection), MIGRATIONS[-1][0])
+        finally:
+            connection.close()
+
+    def testTagsOfPosts(self):
+        tag_post = association_table__tag_post.c
+        s = self.db.DBsession()
+        q = s.query(tag_post.post_id, Tag.name).filter(Tag.id == tag_post.tag_id, tag_post.post_id.in_([1, 2, 3]))
+        self.assertUsesIndex(q.order_by(Tag.name), 'tag_post', 'ix_tag_post_post_id_tag_id')
+        q = s.query(tag_post.tag_id, tag_post.post_id).filter(tag_post.post_id > 10)
+        self.assertUsesIndex(q.order_by(tag_post.post_id), 'tag_post', 'ix_tag_post_post_id_tag_id')
+
+    def testBoardListing(self):
+        q = self.db.DBsession().query(Post.id).filter(Post.board_id == 1)
+        q = q.filter(or_(Post.post_id < 100, and_(Post.post_id == 100, Post.id < 5)))
+        self.assertUsesIndex(q.order_by(Post.post_id.desc(), Post.id.desc()), 'post', 'ix_post_board_id_post_id')
+
+    def testModifiedPools(self):
+        q = self.db.DBsession().query(Pool).filter_by(modified=True).filter(Pool.updated_at != None)
+        self.assertUsesIndex(q.order_by(Pool.updated_at, Pool.id), 'pool', 'ix_pool_modified_updated_at')
+
+    def testPendingImages(self):
+        q = self.db.DBsession().query(Image.id).filter(Image.download_state == Image.PENDING, Image.id > 10)
+        self.assertUsesIndex(q.order_by(Image.id).limit(100), 'image', 'ix_image_download_state')
+
+    def testImagesOfPosts(self):
+        q = self.db.DBsession().query(Post.id, Post.image_id).filter(Post.image_id.in_([1, 2, 3]))
+        self.assertUsesIndex(q, 'post', 'ix_post_image_id')
+
+    def testImageSize(self):
+        q = self.db.DBsession().query(Image.id).filter(Image.width >= 1920, Image.height >= 1080)
+        plan = self.plan(q)
+        self.assertTrue(any('INDEX ix_image_width_height' in step or 'INDEX ix_image_height' in step
+                            for step in plan), plan)
+
+    def testOldDatabase(self):
+        # a database made before the migrations gets the new columns and
+        # indexes when it is opened
+        self.tearDown()
+        os.mkdir(self.path)
+        connection = sqlite3.connect(self.dbname)
+        connection.executescript(BASELINE_SCHEMA)
+        connection.execute("INSERT INTO board (id, host, alias) VALUES (1, 'http://example', 'example')")
+        connection.executemany("INSERT INTO image (id, md5, file_ext, file_size) VALUES (?, ?, '.jpg', 10)",
+                               [(i, '%032x' % i) for i in range(1, 4)])
+        connection.executemany("INSERT INTO post (id, post_id, board_id, image_id) VALUES (?, ?, 1, ?)",
+                               [(i, 100 + i, i) for i in range(1, 4)])
+        connection.commit()
+        connection.close()
+
+        self.db = Database(self.dbname)
+        self.testVersion()
+        connection = self.db.engine.connect()
+        try:
+            columns = set(row[1] for row in connection.execute("pragma table_info(image)"))
+            self.assertTrue(set(['download_state', 'download_size', 'download_mtime']) <= columns)
+            indexes = set(row[1] for row in connection.execute("pragma index_list(image)"))
+            self.assertIn('ix_image_download_state', indexes)
+            rows = connection.execute("SELECT id, download_state, download_size, download_mtime "
+                                      "FROM image ORDER BY id").fetchall()
+            self.assertEqual([tuple(row) for row in rows], [(i, Image.PENDING, None, None) for i in range(1, 4)])
+        finally:
+            connection.close()
+        self.testTagsOfPosts()
+        self.testBoardListing()
+        self.testModifiedPools()
+        self.testPendingImages()
+
+        # the posts of the old database are found by the new queries
+        self.db.clearHost()
+        self.assertEqual(len(list(self.db.iterFiles())[0]), 3)
+
+if __name__ == '__main__':
+    unittest.main()
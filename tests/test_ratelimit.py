@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import unittest
+
+from danbooru.error import DanbooruError
+from danbooru.ratelimit import TokenBucket, get_bucket
+
+
+class GetBucketTest(unittest.TestCase):
+
+    def testStrictestLimits(self):
+        bucket = get_bucket('strict.example', 2, 5)
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertIs(get_bucket('strict.example', 4, 1), bucket)
+            self.assertIs(get_bucket('strict.example', 4, 1), bucket)
+            self.assertIs(get_bucket('strict.example', 0.5, 3), bucket)
+        # a warning for every new setting, not for every call
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual((bucket.rate, bucket.burst), (0.5, 1))
+        self.assertIs(get_bucket('strict.example', 2, 5), bucket)
+        self.assertEqual((bucket.rate, bucket.burst), (0.5, 1))
+
+    def testInvalidRate(self):
+        for rate in (0, -1, None):
+            self.assertRaises(DanbooruError, TokenBucket, rate)
+        bucket = get_bucket('invalid.example', 1)
+        self.assertRaises(DanbooruError, get_bucket, 'invalid.example', 0)
+        self.assertEqual(bucket.rate, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from danbooru.database import Database
+from danbooru.models import Board, Post
+from danbooru.utils import parse_query
+
+TAGS = ['t%i' % i for i in range(10)]
+BOARDS = {'a': 'http://a.test', 'b': 'http://b.test'}
+
+SEARCHES = [
+            't0',
+            't0 t1',
+            't1 -t2',
+            't0 -t1 -t2',
+            '~t3 ~t4',
+            't5|t6 t0',
+            't1 t2|t7 -t3',
+            't0 -missing',
+            't0|missing',
+            'missing',
+            't0 missing|other',
+           ]
+
+FILTERS = ['', 'rating:s', 'rating:e', 'width:>900', 'width:<1000', 'width:1000']
+
+
+class SearchTest(unittest.TestCase):
+    '''Compares the results of getPostIds with the ones of a search over the
+    posts kept in memory.'''
+
+    def setUp(self):
+        random.seed(7)
+        self.path = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.path, 'test.sqlite'))
+        self.posts = []
+        self.next_id = 1
+        self.addPosts(300)
+
+    def tearDown(self):
+        self.db.tag_index.clear()
+        self.db.DBsession.remove()
+        self.db.engine.dispose()
+        shutil.rmtree(self.path)
+
+    def addPosts(self, count):
+        for alias in sorted(BOARDS):
+            posts = []
+            for _ in range(count // len(BOARDS)):
+                # some images are in both boards
+                md5 = random.randrange(count)
+                posts.append({'post_id': self.next_id, 'md5': '%032x' % md5,
+                              'file_url': 'http://test/%i.jpg' % self.next_id,
+                              'tags': random.sample(TAGS, random.randint(1, 4)),
+                              'rating': random.choice('sqe'), 'width': 800 + md5 % 5 * 100,
+                              'height': 600, 'file_size': 1000, 'created_at': None})
+                self.next_id += 1
+            self.db.setHost(BOARDS[alias], alias)
+            self.db.savePosts(posts)
+            for post in posts:
+                self.posts.append(dict(post, alias=alias))
+
+    def ids(self):
+        q = self.db.DBsession().query(Post.id, Board.alias, Post.post_id).join(Post.board)
+        return dict(((alias, post_id), x) for x, alias, post_id in q)
+
+    def matches(self, post, query):
+        tags = set(post['tags'])
+        for term in query['tags']:
+            if term.startswith('-'):
+                if term[1:] in tags:
+                    return False
+            elif term.startswith('~'):
+                continue
+            elif not tags.intersection(term.split('|')):
+                return False
+        any_tags = [x[1:] for x in query['tags'] if x.startswith('~')]
+        if any_tags and not tags.intersection(any_tags):
+            return False
+
+        if query.get('site') and post['alias'] != query['site']:
+            return False
+        if query.get('rating') and post['rating'] != query['rating']:
+            return False
+        if query.get('width'):
+            # the image keeps the width of its first post
+            width = post['width']
+            if query['width_type'] == '<':
+                return width < query['width']
+            if query['width_type'] == '>':
+                return width > query['width']
+            return width == query['width']
+        return True
+
+    def expected(self, query, blacklist=None, whitelist=None):
+        ids = self.ids()
+        images = set()
+        result = []
+        for post in sorted(self.posts, key=lambda x: x['post_id'], reverse=True):
+            if not self.matches(post, query):
+                continue
+            # one post per image, the newest one, then the blacklisted
+            # posts are hidden
+            if post['md5'] in images:
+                continue
+            images.add(post['md5'])
+            if blacklist and set(post['tags']).intersection(blacklist):
+                if not whitelist or not set(post['tags']).intersection(whitelist):
+                    continue
+            result.append(ids[post['alias'], post['post_id']])
+        return result
+
+    def search(self, text, blacklist=None, whitelist=None):
+        query = parse_query(text)
+        if query.get('site'):
+            self.db.setHost(None, query['site'])
+        else:
+            self.db.clearHost()
+        return self.db.getPostIds(query['tags'], query, blacklist, whitelist), query
+
+    def check(self):
+        for site in ('', 'site:a', 'site:b'):
+            for tags in SEARCHES:
+                for item in FILTERS:
+                    text = ' '.join(x for x in (tags, site, item) if x)
+                    ids, query = self.search(text)
+                    self.assertEqual(ids, self.expected(query), text)
+
+    def testSearch(self):
+        self.check()
+
+    def testBlacklist(self):
+        for text in ('t0', 't1 -t2', 'site:b t3|t4'):
+            ids, query = self.search(text, ['t5', 't6'], ['t7'])
+            self.assertEqual(ids, self.expected(query, ['t5', 't6'], ['t7']), text)
+
+    def testSavePosts(self):
+        # the searches above are cached and the index is built, the new
+        # posts must be added to both
+        self.check()
+        self.addPosts(100)
+        self.check()
+
+    def testDeletePosts(self):
+        self.check()
+        self.db.deletePostsByTags(['t1', 't8'], ['t0'])
+        self.posts = [x for x in self.posts
+                      if not set(x['tags']).intersection(['t1', 't8']) or 't0' in x['tags']]
+        self.check()
+        self.addPosts(100)
+        self.check()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import io
+import json
+import unittest
+
+from danbooru.utils import grid_columns, iter_json_array, visible_rows
+
+
+class IterJsonArrayTest(unittest.TestCase):
+
+    ITEMS = [
+        {'id': 1234, 'tags': 'a b c', 'score': -3, 'ratio': 1.5e-3},
+        {'id': 5, 'nested': {'list': [1, 22, 333], 'empty': {}}, 'ok': True},
+        {'id': 6, 'name': 'ñandú 日本語 ☃', 'escaped': 'quote " and \\ slash'},
+        1234, 5, -0.25, 6e10, True, False, None, 'text', [], [[1], 2],
+    ]
+
+    def parse(self, data, chunk_size):
+        return list(iter_json_array(io.BytesIO(data), chunk_size))
+
+    def testSmallChunks(self):
+        for indent in (None, 2):
+            data = json.dumps(self.ITEMS, indent=indent, ensure_ascii=False).encode('utf8')
+            for chunk_size in range(1, 24):
+                self.assertEqual(self.parse(data, chunk_size), self.ITEMS,
+                                 'chunk size %i' % chunk_size)
+
+    def testNumbersSplitAcrossChunks(self):
+        self.assertEqual(self.parse(b'[1234, 5]', 2), [1234, 5])
+        self.assertEqual(self.parse(b'[1.5e3,-20]', 1), [1500.0, -20])
+
+    def testEmptyArray(self):
+        for chunk_size in (1, 2, 16):
+            self.assertEqual(self.parse(b' [ ] ', chunk_size), [])
+
+    def testTruncatedArray(self):
+        for data in (b'[{"id": 1}, {"id"', b'[1, 2', b'[12'):
+            with self.assertRaises(ValueError):
+                self.parse(data, 3)
+
+    def testNotAnArray(self):
+        with self.assertRaises(ValueError):
+            self.parse(b'{"id": 1}', 4)
+
+
+class VisibleRowsTest(unittest.TestCase):
+    '''Checks the rows against the layout of a QListView in icon mode, the
+    items start one spacing away from the corner and wrap when they and the
+    spacing after them don't fit in the width.'''
+
+    def layout(self, count, width, size, spacing):
+        rects = []
+        x = y = spacing
+        for _ in range(count):
+            if x + size + spacing > width and x > spacing:
+                x = spacing
+                y += size + spacing
+            rects.append((x, y))
+            x += size + spacing
+        return rects
+
+    def testIconLayout(self):
+        count = 200
+        for width, size, spacing in ((800, 160, 5), (300, 100, 5), (90, 100, 5), (1000, 64, 0)):
+            rects = self.layout(count, width, size, spacing)
+            columns = grid_columns(width, size, spacing)
+            for offset in range(0, 2000, 37):
+                for height in (1, 200, 600):
+                    # the view scrolled offset pixels, the first item is at
+                    # spacing - offset in the viewport
+                    rows = visible_rows(count, columns, size + spacing, offset - spacing, height)
+                    expected = [row for row, (x, y) in enumerate(rects)
+                                if y < offset + height and y + size > offset]
+                    self.assertTrue(set(expected).issubset(rows))
+                    # at most the rows of the lines that only show spacing
+                    self.assertLessEqual(len(rows), len(expected) + 2 * columns)
+
+    def testNewResults(self):
+        # the first page of a search and the page fetched at the bottom of
+        # the view, only the lines on screen are requested
+        columns = grid_columns(800, 160, 5)
+        self.assertEqual(visible_rows(200, columns, 165, -5, 600), range(0, 16))
+        top = (200 // columns) * 165 - 600
+        self.assertEqual(visible_rows(400, columns, 165, top, 600), range(184, 200))
+
+    def testBounds(self):
+        self.assertEqual(visible_rows(0, 4, 100, 0, 500), range(0, 0))
+        self.assertEqual(visible_rows(10, 4, 100, 0, 150), range(0, 8))
+        self.assertEqual(visible_rows(10, 4, 100, 5000, 150), range(10, 10))
+        self.assertEqual(visible_rows(10, 4, 100, -5, 50), range(0, 4))
+        self.assertEqual(grid_columns(50, 100, 5), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Compares PostFilter and Api._processPosts with the per post set building
+and query matching they replaced on synthetic posts.'''
+
+import os
+import re
+import sys
+import copy
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from danbooru.api import Api
+from danbooru.utils import PostFilter, parse_query
+
+TAGS = ['t%i' % i for i in range(3000)]
+
+
+def make_posts(count):
+    random.seed(1)
+    return [{'id': i, 'tags': ' '.join(random.sample(TAGS, 25)), 'rating': 'sqe'[i % 3],
+             'width': 800 + i % 400, 'height': 600 + i % 300} for i in range(count)]
+
+
+def old_matches(post, query):
+    if query.get('rating') and post['rating'] != query['rating']:
+        return False
+    for key in ('width', 'height'):
+        if query.get(key):
+            kind = query[key + '_type']
+            if kind == "=" and not post[key] == query[key]:
+                return False
+            if kind == "<" and not post[key] < query[key]:
+                return False
+            if kind == ">" and not post[key] > query[key]:
+                return False
+    return True
+
+
+def old_process(posts, query, blacklist, whitelist):
+    result = []
+    for post in posts:
+        post['post_id'] = post.pop('id')
+        post['tags'] = list(set(re.sub(' +', ' ', post['tags']).split(' ')))
+        if blacklist and set(post['tags']).intersection(blacklist):
+            if not whitelist or not set(post['tags']).intersection(whitelist):
+                continue
+        if not old_matches(post, query):
+            continue
+        result.append(post)
+    return result
+
+
+def new_process(posts, query, blacklist, whitelist):
+    api = Api.__new__(Api)
+    return list(api._processPosts(posts, PostFilter(query, blacklist, whitelist)))
+
+
+def measure(name, function, *args):
+    start = time.time()
+    result = function(*args)
+    print("%-16s %6i posts kept in %.3f s" % (name, len(result), time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--query', default='rating:s width:>900 height:<800')
+    parser.add_argument('--blacklist', nargs='+', default=['t1', 't2', 't3', 't4', 't5'])
+    parser.add_argument('--whitelist', nargs='+', default=['t7'])
+    args = parser.parse_args()
+
+    posts = make_posts(args.posts)
+    query = parse_query(args.query)
+    for name, function in (('old process', old_process), ('new process', new_process)):
+        measure(name, function, copy.deepcopy(posts), query, args.blacklist, args.whitelist)
+
+    # the query terms alone, on posts with their tags already split
+    for post in posts:
+        post['tags'] = post['tags'].split()
+    post_filter = PostFilter(query)
+    measure('old filter', lambda: [x for x in posts if old_matches(x, query)])
+    measure('new filter', lambda: [x for x in posts if post_filter.matchesQuery(x)])
+
+
+if __name__ == '__main__':
+    main()
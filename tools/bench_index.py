@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Compares the searches of the tag index with the GROUP BY/HAVING queries
+they replaced on a synthetic database. Also times building, saving and
+mapping the index file.'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.sql.expression import func, distinct, not_
+
+from danbooru.database import Database
+from danbooru.models import Post, Tag
+
+TAGS = 20000
+TAGS_PER_POST = 20
+
+QUERIES = [
+           ['t0', 't1'],
+           ['t0', 't5'],
+           ['t3', 't50'],
+           ['t100', 't1000'],
+           ['t0', '-t1'],
+           ['t2|t40'],
+          ]
+
+
+def build(path, posts):
+    '''Writes the posts straight with sqlite, the tags are picked with a
+    zipf like distribution.'''
+    db = Database(path)
+    db.DBsession.remove()
+    db.engine.dispose()
+    random.seed(2)
+    connection = sqlite3.connect(path)
+    connection.execute("INSERT INTO board (id, host, alias) VALUES (1, 'http://bench', 'bench')")
+    connection.executemany("INSERT INTO tag (id, name) VALUES (?, ?)",
+                           ((i + 1, 't%i' % i) for i in range(TAGS)))
+    connection.executemany("INSERT INTO image (id, md5) VALUES (?, ?)",
+                           ((i, '%032x' % i) for i in range(1, posts + 1)))
+    connection.executemany("INSERT INTO post (id, post_id, image_id, board_id) VALUES (?, ?, ?, 1)",
+                           ((i, i, i) for i in range(1, posts + 1)))
+    weights = [1.0 / (i + 1) for i in range(TAGS)]
+
+    def rows():
+        for post in range(1, posts + 1):
+            for tag in set(random.choices(range(1, TAGS + 1), weights, k=TAGS_PER_POST)):
+                yield (tag, post)
+    connection.executemany("INSERT INTO tag_post (tag_id, post_id) VALUES (?, ?)", rows())
+    connection.commit()
+    connection.close()
+
+
+def old_search(db, tags, limit):
+    '''The search of getANDPosts and getORPosts before the tag index.'''
+    s = db.DBsession()
+    include = [x for x in tags if not x.startswith('-') and '|' not in x]
+    exclude = [x[1:] for x in tags if x.startswith('-')]
+    groups = [x.split('|') for x in tags if '|' in x]
+    q = s.query(Post.id).join(Post.tags).filter(Post.board_id == db.board.id)
+    if groups:
+        q = q.filter(Tag.name.in_(groups[0])).group_by(Post.image_id)
+    else:
+        q = q.filter(Tag.name.in_(include)).group_by(Post.image_id)
+        q = q.having(func.count(distinct(Tag.name)) == len(include))
+    if exclude:
+        excluded = s.query(Post.id).join(Post.tags).filter(Tag.name.in_(exclude))
+        q = q.filter(not_(Post.id.in_(excluded)))
+    return [x for x, in q.order_by(Post.post_id.desc()).limit(limit)]
+
+
+def new_search(db, tags, limit):
+    # every search is measured without the results cache
+    db.query_cache.clear()
+    return db.getPostIds(tags)[:limit]
+
+
+def measure(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=1000000,
+            help='posts of the synthetic database')
+    parser.add_argument('--limit', type=int, default=100,
+            help='results of every search')
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp()
+    try:
+        dbname = os.path.join(path, 'bench.sqlite')
+        _, elapsed = measure(build, dbname, args.posts)
+        print("Built %i posts in %.1f s" % (args.posts, elapsed))
+
+        db = Database(dbname)
+        db.setHost('http://bench', 'bench')
+        _, elapsed = measure(db.getPostIds, ['t0'])
+        print("Index built from the database in %.2f s" % elapsed)
+        db.tag_index.optimize()
+        _, elapsed = measure(db.tag_index.save, db.index_path)
+        print("Index saved in %.2f s, %i MB" % (elapsed, os.path.getsize(db.index_path) // (1024 * 1024)))
+        db.DBsession.remove()
+        db.engine.dispose()
+
+        db = Database(dbname)
+        db.setHost('http://bench', 'bench')
+        _, elapsed = measure(db.getPostIds, ['t0'])
+        print("Index mapped and checked in %.2f s" % elapsed)
+
+        for tags in QUERIES:
+            new, new_time = measure(new_search, db, tags, args.limit)
+            old, old_time = measure(old_search, db, tags, args.limit)
+            print("%-16s index %8.4f s  sql %8.4f s  same results: %s" %
+                  (' '.join(tags), new_time, old_time, new == old))
+        db.DBsession.remove()
+        db.engine.dispose()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Compares Database.deletePostsByTags with the single transaction purge it
+replaced on a synthetic database, deleting the posts of a blacklisted tag
+except the ones with a whitelisted tag.'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.sql.expression import not_
+
+from danbooru.database import Database
+from danbooru.models import Post, Image, Tag
+
+TAGS = 5000
+TAGS_PER_POST = 20
+
+
+def build(path, posts):
+    '''Writes the posts straight with sqlite, the tags are picked with a
+    zipf like distribution.'''
+    db = Database(path)
+    db.DBsession.remove()
+    db.engine.dispose()
+    random.seed(3)
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT INTO tag (id, name) VALUES (?, ?)",
+                           ((i, 't%i' % i) for i in range(1, TAGS + 1)))
+    connection.executemany("INSERT INTO image (id, md5, download_state) VALUES (?, ?, 0)",
+                           ((i, '%032x' % i) for i in range(1, posts + 1)))
+    connection.executemany("INSERT INTO post (id, post_id, image_id, board_id) VALUES (?, ?, ?, 1)",
+                           ((i, i, i) for i in range(1, posts + 1)))
+    weights = [1.0 / (i + 1) for i in range(TAGS)]
+
+    def rows():
+        for post in range(1, posts + 1):
+            for tag in set(random.choices(range(1, TAGS + 1), weights, k=TAGS_PER_POST)):
+                yield (tag, post)
+    connection.executemany("INSERT INTO tag_post (tag_id, post_id) VALUES (?, ?)", rows())
+    connection.commit()
+    connection.close()
+
+
+def old_purge(db, blacklist, whitelist):
+    s = db.DBsession()
+    subq = s.query(Post.id).distinct().join(Post.tags).filter(Tag.name.in_(whitelist))
+    q = s.query(Post.id).distinct().join(Post.tags).filter(Tag.name.in_(blacklist)).except_(subq)
+    posts = s.query(Post).filter(Post.id.in_(q)).delete(synchronize_session='fetch')
+    q = s.query(Post.image_id).distinct()
+    images = s.query(Image.id).filter(not_(Image.id.in_(q))).delete(synchronize_session='fetch')
+    q = s.query(Tag.id).join(Post.tags)
+    tags = s.query(Tag.id).filter(not_(Tag.id.in_(q))).delete(synchronize_session='fetch')
+    s.commit()
+    return posts, images, tags
+
+
+def new_purge(db, blacklist, whitelist):
+    return db.deletePostsByTags(blacklist, whitelist)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=1000000,
+            help='posts of the synthetic database')
+    parser.add_argument('--blacklist', nargs='+', default=['t3'])
+    parser.add_argument('--whitelist', nargs='+', default=['t1'])
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp()
+    try:
+        base = os.path.join(path, 'base.sqlite')
+        start = time.time()
+        build(base, args.posts)
+        print("Built %i posts in %.1f s" % (args.posts, time.time() - start))
+        for name, purge in (('old', old_purge), ('new', new_purge)):
+            dbname = os.path.join(path, '%s.sqlite' % name)
+            shutil.copy(base, dbname)
+            db = Database(dbname)
+            db.clearHost()
+            # the tag index is loaded outside of the measure
+            db.getPostIds(args.whitelist)
+            start = time.time()
+            result = purge(db, args.blacklist, args.whitelist)
+            print("%s: %s in %.1f s" % (name, result, time.time() - start))
+            db.DBsession.remove()
+            db.engine.dispose()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+#   Copyright 2012 codestation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+'''Compares the sqlite tuning profile of Database with the sqlite defaults.
+A writer process saves posts like the daemon while this process reads post
+details like the GUI, the ingest rate and the read latency are reported.'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from danbooru.database import Database
+
+# the sqlite defaults, the busy timeout is kept so the reads wait for the
+# writer instead of failing
+DEFAULT_PRAGMAS = {
+                   'journal_mode': 'DELETE',
+                   'synchronous': 'FULL',
+                   'cache_size': -2000,
+                   'mmap_size': 0,
+                   'temp_store': 'DEFAULT',
+                  }
+
+BATCH = 100
+TAGS = ['tag%i' % i for i in range(2000)]
+
+
+def make_posts(first, count):
+    return [{'post_id': i, 'md5': '%032x' % i, 'file_url': 'http://bench/%i.jpg' % i,
+             'tags': random.sample(TAGS, 20), 'width': 1000, 'height': 800, 'rating': 's',
+             'file_size': 1000, 'created_at': None} for i in range(first, first + count)]
+
+
+def open_db(dbname, pragmas):
+    db = Database(dbname, pragmas=pragmas)
+    db.setHost('http://bench', 'bench')
+    return db
+
+
+def writer(dbname, pragmas, first, count, results):
+    db = open_db(dbname, pragmas)
+    start = time.time()
+    for offset in range(0, count, BATCH):
+        db.savePosts(make_posts(first + offset, min(BATCH, count - offset)))
+    results.put(time.time() - start)
+
+
+def run(name, pragmas, args):
+    path = tempfile.mkdtemp()
+    try:
+        dbname = os.path.join(path, 'bench.sqlite')
+        db = open_db(dbname, pragmas)
+        for offset in range(0, args.initial, BATCH):
+            db.savePosts(make_posts(offset + 1, BATCH))
+        ids = db.getPostIds()
+
+        # sqlite connections can't be used after a fork
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        process = context.Process(target=writer, args=(dbname, pragmas, args.initial + 1, args.posts, results))
+        process.start()
+        latencies = []
+        while process.is_alive():
+            chunk = random.sample(ids, args.read_size)
+            start = time.time()
+            db.getPostDetails(chunk)
+            db.DBsession().commit()
+            latencies.append(time.time() - start)
+        process.join()
+        if process.exitcode:
+            sys.exit("The writer failed")
+        elapsed = results.get()
+
+        latencies.sort()
+        print("%-8s ingest %7.0f posts/s  reads %5i  p50 %6.1f ms  p95 %6.1f ms  max %7.1f ms" %
+              (name, args.posts / elapsed, len(latencies),
+               latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000,
+               latencies[-1] * 1000))
+        db.DBsession.remove()
+        db.engine.dispose()
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--initial', type=int, default=5000,
+            help='posts saved before the measure')
+    parser.add_argument('--posts', type=int, default=20000,
+            help='posts saved by the writer')
+    parser.add_argument('--read-size', type=int, default=50,
+            help='posts read by every query')
+    args = parser.parse_args()
+    random.seed(1)
+    run('default', DEFAULT_PRAGMAS, args)
+    random.seed(1)
+    run('tuned', None, args)
+
+
+if __name__ == '__main__':
+    main()